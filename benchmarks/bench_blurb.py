@@ -0,0 +1,26 @@
+import random
+import timeit
+
+from bs4 import BeautifulSoup
+
+import steambot.bot
+from benchmarks.synthetic import html_description
+
+def legacy_blurbify(markup):
+    # steambot.bot.blurbify as of 1.2.6.
+    text = BeautifulSoup(markup, features="html.parser").get_text(' ')
+    if len(text) > 400:
+        text = text[:400] + '...'
+    return text
+
+def run(number=200):
+    rnd = random.Random(0)
+    for size in [1000, 5000, 50000]:
+        markup = html_description(rnd, size)
+        assert steambot.bot.blurbify(markup) == legacy_blurbify(markup)
+        for name, func in [('BeautifulSoup', legacy_blurbify), ('BlurbExtractor', steambot.bot.blurbify)]:
+            seconds = min(timeit.repeat(lambda: func(markup), number=number, repeat=5)) / number
+            print(f"{size:6} chars  {name:16} {seconds * 1000:8.3f} ms")
+
+if __name__ == '__main__':
+    run()
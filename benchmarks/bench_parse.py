@@ -0,0 +1,41 @@
+import timeit
+import xml.etree.ElementTree as ET
+
+import steambot.feeds
+from benchmarks.synthetic import steam_feed, steam_news_json
+
+def legacy_parse(rss):
+    # steambot.feeds.parse as of 1.2.6: full tree and dateutil for every item.
+    items = []
+    for tag in ET.fromstring(rss).findall('channel/item'):
+        item = steambot.feeds.NewsItem.from_tag(tag)
+        item.date = steambot.feeds.dateutil.parser.parse(tag.find('pubDate').text)
+        items.append(item)
+    return sorted(items)
+
+def run(number=50):
+    feed = steam_feed(440, items=20, description_size=5000)
+    newest = max(steambot.feeds.parse(feed)).timestamp()
+    news = steam_news_json(440, items=5)
+    first_news = steam_news_json(440, items=1)
+    cases = [
+        ('legacy parse + items_after', lambda: steambot.feeds.items_after(legacy_parse(feed), newest - 86400 * 2)),
+        ('parse + items_after', lambda: steambot.feeds.items_after(steambot.feeds.parse(feed), newest - 86400 * 2)),
+        ('parse_after (2 new)', lambda: steambot.feeds.parse_after(feed, newest - 86400 * 2)),
+        ('parse_after (none new)', lambda: steambot.feeds.parse_after(feed, newest)),
+        ('parse_after (first seen)', lambda: steambot.feeds.parse_after(feed)),
+        ('news API (2 new)', lambda: steambot.feeds.parse_news_json_after(news, newest - 86400 * 2)),
+        ('news API (first seen)', lambda: steambot.feeds.parse_news_json_after(first_news)),
+    ]
+    print(f"Feed size: {len(feed) / 1024:.0f} KiB, 20 items")
+    print(f"News API size: {len(news) / 1024:.1f} KiB, 5 items; {len(first_news) / 1024:.1f} KiB, 1 item")
+    for name, func in cases:
+        seconds = min(timeit.repeat(func, number=number, repeat=5)) / number
+        print(f"{name:28} {seconds * 1000:8.3f} ms")
+    date = 'Tue, 14 Mar 2023 18:00:00 +0000'
+    for name, func in [('dateutil', lambda: steambot.feeds.dateutil.parser.parse(date)), ('parse_date', lambda: steambot.feeds.parse_date(date))]:
+        seconds = min(timeit.repeat(func, number=10000, repeat=5)) / 10000
+        print(f"{name:28} {seconds * 1000000:8.3f} us")
+
+if __name__ == '__main__':
+    run()
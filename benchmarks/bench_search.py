@@ -0,0 +1,65 @@
+import random
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import steambot.index
+import steambot.search
+from benchmarks.synthetic import app_names
+
+def make_queries(rnd, entries, count):
+    # (kind, query, appid it was made from)
+    queries = []
+    for appid, name in rnd.sample(entries, count):
+        words = name.split()
+        longest = max(words, key=len)
+        queries.append(('full name', name, appid))
+        queries.append(('one word', longest, appid))
+        position = rnd.randrange(1, len(longest))
+        typo = longest[:position] + rnd.choice('abcdefghijklmnopqrstuvwxyz') + longest[position + 1:]
+        queries.append(('typo', name.replace(longest, typo), appid))
+        queries.append(('being typed', name[:max(4, len(name) * 2 // 3)], appid))
+    return queries
+
+def run(apps=50000, samples=200, seed=0):
+    rnd = random.Random(seed)
+    entries = app_names(apps, seed)
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        config = {'steam_index_dir': str(directory / 'steamapps_index')}
+        start = time.perf_counter()
+        index = steambot.index.create_steamapp_index(config)
+        writer = index.writer(limitmb=256)
+        for appid, name in entries:
+            writer.add_document(appid=appid, name=name)
+        writer.commit()
+        print(f"whoosh build:  {time.perf_counter() - start:6.1f} s")
+        start = time.perf_counter()
+        steambot.search.write_search_index(directory / 'search.bin', entries)
+        print(f"trigram build: {time.perf_counter() - start:6.1f} s, {(directory / 'search.bin').stat().st_size / 2**20:.1f} MiB")
+        engines = [
+            ('whoosh', steambot.index.SteamApps(index).search_names),
+            ('trigram', steambot.search.SearchIndex.load(directory / 'search.bin').search),
+        ]
+        results = {}
+        for name, search in engines:
+            for kind, query, appid in make_queries(random.Random(seed), entries, samples):
+                start = time.perf_counter()
+                found = search(query)
+                seconds = time.perf_counter() - start
+                results.setdefault((name, kind), []).append((seconds, [x[0] for x in found], appid))
+        print(f"{apps} apps, {samples} queries of each kind; found = the app the query was made from is in the results")
+        print(f"{'engine':8} {'kind':12} {'mean':>8} {'p95':>8} {'found':>6} {'of whoosh':>10}")
+        for (name, kind), timings in results.items():
+            seconds = sorted([x[0] for x in timings])
+            found = sum([appid in appids for _, appids, appid in timings]) / len(timings)
+            # How many of whoosh's results the engine also returned.
+            whoosh = results[('whoosh', kind)]
+            overlaps = [len(set(appids) & set(other)) / len(other) for (_, appids, _), (_, other, _) in zip(timings, whoosh) if other]
+            recall = statistics.mean(overlaps) if overlaps else float('nan')
+            print(f"{name:8} {kind:12} {statistics.mean(seconds) * 1000:6.2f}ms {seconds[len(seconds) * 95 // 100] * 1000:6.2f}ms "
+                f"{found:6.0%} {recall:10.0%}")
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,71 @@
+import logging
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import steambot.config
+import steambot.index
+import steambot.state
+import steambot.store
+
+IMPORTS = [
+    # What steambot.scripts imported for every action as of 1.2.6.
+    ('legacy (everything)', 'import requests, steambot.bot, steambot.feeds, steambot.index, steambot.poller, steambot.state'),
+    ('steambot --help', 'import steambot.scripts'),
+    ('steambot index', 'import steambot.scripts, requests, steambot.index'),
+    ('steambot poller', 'import steambot.scripts, steambot.poller, steambot.state'),
+    ('steambot bot', 'import steambot.scripts, steambot.bot, steambot.index, steambot.state'),
+]
+
+def time_process(code, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def synthetic_config(directory, servers, apps):
+    config = dict(steambot.config.DEFAULT_CONFIG,
+        state_backend='sqlite',
+        state_database=str(directory / 'state.sqlite3'),
+        state_file=str(directory / 'state.pickle'),
+        steam_index_dir=str(directory / 'steamapps_index'),
+        steam_names_file=str(directory / 'steamapps_names.bin'))
+    rnd = random.Random(0)
+    index = steambot.index.create_steamapp_index(config)
+    writer = index.writer()
+    for appid in range(apps):
+        writer.add_document(appid=appid, name=f"Game {appid}")
+    writer.commit()
+    steambot.index.write_name_table(config['steam_names_file'], [(appid, f"Game {appid}") for appid in range(apps)])
+    store = steambot.store.SqliteStore(config['state_database'])
+    with store.connection:
+        store.connection.executemany("INSERT INTO servers (id, name, channel) VALUES (?, ?, ?)",
+            [(rnd.getrandbits(60), f"Server {i}", rnd.getrandbits(60)) for i in range(servers)])
+        store.connection.execute("INSERT INTO subscriptions SELECT id, abs(random()) % ? FROM servers", (apps,))
+    store.close()
+    return config
+
+def run(servers=20000, apps=20000, repeat=5):
+    baseline = time_process('pass', repeat)
+    print(f"Python start-up: {baseline * 1000:.0f} ms; import times below exclude it.")
+    for name, code in IMPORTS:
+        print(f"{name:20} {(time_process(code, repeat) - baseline) * 1000:8.0f} ms")
+    log = logging.getLogger('bench')
+    with tempfile.TemporaryDirectory() as directory:
+        config = synthetic_config(Path(directory), servers, apps)
+        start = time.perf_counter()
+        steambot.index.SteamApps.load(config, log)
+        program_state = steambot.state.ProgramState.load(config, log)
+        seconds = time.perf_counter() - start
+        program_state.store.close()
+    # The bot used to load both before connecting; now it loads them while connecting.
+    print(f"Loading {apps} apps and {servers} servers: {seconds * 1000:.0f} ms (no longer delays connecting)")
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,91 @@
+import gc
+import pickle
+import timeit
+import tracemalloc
+
+import steambot.state
+from benchmarks.suite import synthetic_servers, synthetic_timestamps
+
+class LegacyServer:
+    # steambot.state.Server before it had slots and kept its subscriptions in an array.
+    def __init__(self, name, id_, channel=None, subscribed=None, digest_minutes=None):
+        self.name = name
+        self.id = id_
+        self.channel = channel
+        self.subscribed = subscribed or set()
+        self.digest_minutes = digest_minutes
+        self.changed = False
+        self.state = None
+    def serialize(self):
+        return (self.name, self.id, self.channel, self.subscribed, self.digest_minutes)
+
+class LegacyState:
+    # What ProgramState kept in memory before: a dict of timestamps and {app_id: {server_id: server}}.
+    def __init__(self, servers, timestamps):
+        self.servers = servers
+        self.timestamps = timestamps
+        self.feed_servers = {}
+        for server in servers.values():
+            server.state = self
+            if server.channel is not None:
+                for app_id in server.subscribed:
+                    self.feed_servers.setdefault(app_id, {})[server.id] = server
+    def with_servers(self, app_ids):
+        return [list(self.feed_servers.get(app_id, {}).values()) for app_id in app_ids]
+    def serialize(self):
+        return ([(k, v.serialize()) for k, v in self.servers.items()], self.timestamps, {}, {})
+
+class CompactState(steambot.state.ProgramState):
+    def with_servers(self, app_ids):
+        return [list(self.feed_servers.get(app_id, {}).values()) for app_id in app_ids]
+
+def build_legacy(rows, timestamps):
+    return LegacyState(dict([(id_, LegacyServer(name, id_, channel, set(subscribed))) for name, id_, channel, subscribed in rows]),
+        dict(timestamps))
+
+def build_compact(rows, timestamps):
+    return CompactState(dict([(id_, steambot.state.Server(name, id_, channel, subscribed)) for name, id_, channel, subscribed in rows]),
+        timestamps)
+
+def load_legacy(data):
+    (servers, timestamps, _, _) = pickle.loads(data)
+    return LegacyState(dict([(k, LegacyServer(*v)) for k, v in servers]), timestamps)
+
+def load_compact(data):
+    return CompactState.deserialize(steambot.state.STATE_VERSION, pickle.loads(data))
+
+def traced(func):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        value = func()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return (value, size)
+
+def best(func, number=1):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number
+
+def run(counts=(10000, 100000)):
+    print(f"{'servers':>8} {'model':8} {'memory':>9} {'pickle':>9} {'build':>9} {'save':>9} {'load':>9} {'with_servers':>13}")
+    for count in counts:
+        servers = synthetic_servers(count)
+        timestamps = synthetic_timestamps(servers)
+        rows = [(s.name, s.id, s.channel, list(s.subscribed)) for s in servers.values()]
+        del servers
+        # The apps with new items in a sweep; the most popular ones have the most servers to post to.
+        app_ids = list(timestamps)[:100]
+        for name, build, load in [('legacy', build_legacy, load_legacy), ('compact', build_compact, load_compact)]:
+            (state, size) = traced(lambda: build(rows, timestamps))
+            data = pickle.dumps(state.serialize(), protocol=pickle.HIGHEST_PROTOCOL)
+            build_seconds = best(lambda: build(rows, timestamps))
+            save_seconds = best(lambda: pickle.dumps(state.serialize(), protocol=pickle.HIGHEST_PROTOCOL))
+            load_seconds = best(lambda: load(data))
+            with_servers_seconds = best(lambda: state.with_servers(app_ids), 10)
+            print(f"{count:8} {name:8} {size / 2**20:5.1f} MiB {len(data) / 2**20:5.1f} MiB {build_seconds * 1000:6.0f} ms "
+                f"{save_seconds * 1000:6.0f} ms {load_seconds * 1000:6.0f} ms {with_servers_seconds * 1000:10.2f} ms")
+            del state
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,371 @@
+import argparse
+import asyncio
+import email.utils
+import json
+import logging
+import math
+import multiprocessing
+import random
+import re
+import socket
+import statistics
+import tempfile
+import time
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from xml.sax.saxutils import escape
+
+import steambot.bot
+import steambot.config
+import steambot.feeds
+import steambot.metrics
+import steambot.state
+from benchmarks.suite import peak_rss
+from benchmarks.synthetic import steam_feed
+
+# Items in every served feed, like Steam's.
+FEED_ITEMS = 20
+# Days between two posts of the same app, picked log-uniformly per app.
+POST_GAP_DAYS = (1, 60)
+# Synthetic feeds to take items from when there is no corpus.
+SYNTHETIC_FEEDS = 50
+# Config keys that are durations, and are shortened by the speed-up like the time between posts.
+SCALED_KEYS = ['seconds_between_updates', 'min_seconds_between_updates', 'max_seconds_between_updates',
+    'scheduler_tick_seconds', 'feed_failure_backoff_seconds', 'max_feed_failure_backoff_seconds',
+    'breaker_pause_seconds', 'max_breaker_pause_seconds']
+# Checking for due feeds walks all of them, so ticking faster than this measures only that.
+MIN_TICK_SECONDS = 0.1
+LAG_INTERVAL = 0.05
+LINK_PATTERN = re.compile(r'https://store\.steampowered\.com/news/app/(\d+)/view/(\d+)')
+
+def app_ids_for(count):
+    return list(range(10, 10 + count * 10, 10))
+
+class PostSchedule:
+    # When every app posts, in accelerated time: post k of an app goes up at phase + k * gap.
+    def __init__(self, app_ids, speed, origin, seed=0):
+        rnd = random.Random(seed)
+        self.posts = {}
+        for app_id in app_ids:
+            days = math.exp(rnd.uniform(math.log(POST_GAP_DAYS[0]), math.log(POST_GAP_DAYS[1])))
+            gap = max(days * 86400 / speed, 2.0)
+            # Post FEED_ITEMS is the newest one at the start, so there is a full feed and no negative posts.
+            phase = origin - FEED_ITEMS * gap - rnd.uniform(0, gap)
+            self.posts[app_id] = (phase, gap)
+    def newest(self, app_id, now):
+        (phase, gap) = self.posts[app_id]
+        return math.floor((now - phase) / gap)
+    def post_time(self, app_id, k):
+        # Whole seconds, like the dates in the feed.
+        (phase, gap) = self.posts[app_id]
+        return math.floor(phase + k * gap)
+    def count_between(self, app_id, start, end):
+        return self.newest(app_id, end) - self.newest(app_id, start)
+
+def load_templates(corpus=None):
+    # [[(title, description, image)]] from the recorded feeds, or from synthetic ones.
+    if corpus is not None:
+        bodies = [path.read_bytes() for path in sorted(Path(corpus).glob('*.xml'))]
+        if not bodies:
+            raise Exception(f"No recorded feeds in {corpus}!")
+    else:
+        bodies = [steam_feed(app_id) for app_id in range(SYNTHETIC_FEEDS)]
+    templates = []
+    for body in bodies:
+        items = [steambot.feeds.NewsItem.from_tag(tag) for tag in ET.fromstring(body).findall('channel/item')]
+        if items:
+            templates.append([(item.title or '', item.description or '', item.image) for item in items])
+    return templates
+
+def render_feed(app_id, templates, schedule, newest):
+    item_tags = []
+    for k in range(newest, max(newest - FEED_ITEMS, 0), -1):
+        (title, description, image) = templates[k % len(templates)]
+        date = email.utils.formatdate(schedule.post_time(app_id, k), usegmt=True).replace('GMT', '+0000')
+        link = f'https://store.steampowered.com/news/app/{app_id}/view/{k}'
+        enclosure = f'<enclosure url="{escape(image)}" length="0" type="image/jpeg" />' if image else ''
+        item_tags.append(
+            f'<item><title>{escape(title)}</title>'
+            f'<description><![CDATA[{description.replace("]]>", "]]&gt;")}]]></description>'
+            f'<link>{link}</link><guid isPermaLink="true">{link}</guid><pubDate>{date}</pubDate>{enclosure}</item>')
+    return (f'<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><title>App {app_id} RSS Feed</title>'
+        f'<link>https://store.steampowered.com/news/app/{app_id}</link>{"".join(item_tags)}</channel></rss>').encode('utf-8')
+
+def serve_feeds(options, ports):
+    # Runs in its own process, so serving the feeds doesn't count towards the bot's time and memory.
+    import aiohttp.web
+    app_ids = app_ids_for(options['apps'])
+    schedule = PostSchedule(app_ids, options['speed'], options['origin'], options['seed'])
+    templates = load_templates(options['corpus'])
+    rnd = random.Random(options['seed'])
+    # App ID -> (newest post, ETag, body), so each version of a feed is only rendered once.
+    rendered = {}
+    async def feed(request):
+        app_id = int(request.match_info['id'])
+        if options['latency']:
+            await asyncio.sleep(rnd.expovariate(1 / options['latency']))
+        if app_id not in schedule.posts:
+            return aiohttp.web.Response(status=404)
+        if rnd.random() < options['error_rate']:
+            return aiohttp.web.Response(status=500)
+        newest = schedule.newest(app_id, time.time())
+        cached = rendered.get(app_id)
+        if cached is None or cached[0] != newest:
+            feed_templates = templates[app_id // 10 % len(templates)]
+            cached = rendered[app_id] = (newest, f'"{app_id}-{newest}"', render_feed(app_id, feed_templates, schedule, newest))
+        if request.headers.get('If-None-Match') == cached[1]:
+            return aiohttp.web.Response(status=304, headers={'ETag': cached[1]})
+        return aiohttp.web.Response(body=cached[2], content_type='application/rss+xml', headers={'ETag': cached[1]})
+    async def run():
+        app = aiohttp.web.Application()
+        app.router.add_get('/feeds/{id}', feed)
+        runner = aiohttp.web.AppRunner(app, access_log=None)
+        await runner.setup()
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        await aiohttp.web.SockSite(runner, sock).start()
+        ports.put(sock.getsockname()[1])
+        await asyncio.Event().wait()
+    asyncio.run(run())
+
+class FakeChannel:
+    def __init__(self, channel_id, discord):
+        self.id = channel_id
+        self.name = f"channel-{channel_id}"
+        self.discord = discord
+    async def send(self, content=None, embeds=None, **kwargs):
+        if self.discord.latency:
+            await asyncio.sleep(self.discord.rnd.expovariate(1 / self.discord.latency))
+        self.discord.record(embeds or [])
+
+class FakeDiscord:
+    # Stands in for the channels of the servers; the bot never connects to the gateway.
+    def __init__(self, schedule, latency, seed=0):
+        self.schedule = schedule
+        self.latency = latency
+        self.rnd = random.Random(seed)
+        self.channels = {}
+        self.messages = 0
+        self.embeds = 0
+        # Seconds from posting an item to delivering it, for every delivered item.
+        self.delays = []
+    def attach(self, bot):
+        bot._connection.get_channel = self.get_channel
+    def get_channel(self, channel_id):
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.channels[channel_id] = FakeChannel(channel_id, self)
+        return channel
+    def record(self, embeds):
+        now = time.time()
+        self.messages += 1
+        self.embeds += len(embeds)
+        for embed in embeds:
+            for app_id, k in LINK_PATTERN.findall(json.dumps(embed.to_dict())):
+                self.delays.append(now - self.schedule.post_time(int(app_id), int(k)))
+
+class CountingFetcher:
+    def __init__(self, fetcher):
+        self.fetcher = fetcher
+        self.feeds = 0
+        self.failed = 0
+    async def load_many(self, app_ids, validators, timestamps):
+        loaded = await self.fetcher.load_many(app_ids, validators, timestamps)
+        self.feeds += len(app_ids)
+        self.failed += len([items for _, items, _ in loaded if items is None])
+        return loaded
+
+class ReplayState(steambot.state.ProgramState):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (seconds, feeds checked, new items, failed feeds) per sweep.
+        self.sweeps = []
+    async def poll_feeds(self, fetcher, *args, **kwargs):
+        start = time.monotonic()
+        counter = CountingFetcher(fetcher)
+        result = await super().poll_feeds(counter, *args, **kwargs)
+        if counter.feeds:
+            new_items = sum([len(items) for _, items in result])
+            self.sweeps.append((time.monotonic() - start, counter.feeds, new_items, counter.failed))
+        return result
+
+class ReplayApps:
+    # Stands in for SteamApps, with the parts of its API the bot uses.
+    def name_from_id(self, app_id):
+        return f"App {app_id}"
+    def names_from_ids(self, app_ids):
+        return dict([(app_id, self.name_from_id(app_id)) for app_id in app_ids])
+    def current_names(self):
+        return None
+    async def name_from_id_async(self, app_id):
+        return self.name_from_id(app_id)
+    async def names_from_ids_async(self, app_ids):
+        return self.names_from_ids(app_ids)
+    async def search_names_async(self, name):
+        return []
+    def close(self):
+        pass
+
+def replay_servers(count, app_ids, digest_share, seed=0):
+    # Like synthetic_servers in the suite, but over the replayed apps.
+    rnd = random.Random(seed)
+    servers = {}
+    for i in range(count):
+        id_ = rnd.getrandbits(60)
+        subscribed = set([app_ids[min(int(rnd.paretovariate(0.7)), len(app_ids)) - 1] for _ in range(rnd.randint(1, 20))])
+        # The shortest digest there is; it isn't sped up like the rest.
+        digest_minutes = 1 if rnd.random() < digest_share else None
+        servers[id_] = steambot.state.Server(f"Server {i}", id_, rnd.getrandbits(60), subscribed, digest_minutes)
+    return servers
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+async def replay(args, log):
+    origin = time.time()
+    app_ids = app_ids_for(args.apps)
+    schedule = PostSchedule(app_ids, args.speed, origin, args.seed)
+    options = {'apps': args.apps, 'speed': args.speed, 'origin': origin, 'seed': args.seed, 'corpus': args.corpus,
+        'latency': args.latency, 'error_rate': args.error_rate}
+    context = multiprocessing.get_context('spawn')
+    ports = context.Queue()
+    server = context.Process(target=serve_feeds, args=(options, ports), daemon=True)
+    server.start()
+    try:
+        port = await asyncio.get_running_loop().run_in_executor(None, ports.get, True, 60)
+        with tempfile.TemporaryDirectory() as directory:
+            config = dict(steambot.config.DEFAULT_CONFIG,
+                steam_feed_url=f'http://127.0.0.1:{port}/feeds/{{id}}',
+                embed_cache_file=str(Path(directory) / 'embed_cache.json'),
+                feed_concurrency=args.concurrency)
+            for key in SCALED_KEYS:
+                config[key] = config[key] / args.speed
+            config['scheduler_tick_seconds'] = max(config['scheduler_tick_seconds'], MIN_TICK_SECONDS)
+            servers = replay_servers(args.servers, app_ids, args.digest_share, args.seed)
+            subscribed = set([app_id for server in servers.values() for app_id in server.subscribed])
+            # Everything posted before the start counts as seen, so only new posts are delivered.
+            timestamps = dict([(app_id, schedule.post_time(app_id, schedule.newest(app_id, origin))) for app_id in subscribed])
+            program_state = ReplayState(servers, timestamps)
+            discord = FakeDiscord(schedule, args.discord_latency, args.seed)
+            bot = steambot.bot.create_bot(lambda: (program_state, ReplayApps()), config, log)
+            discord.attach(bot)
+            # What bot.start() does before it connects.
+            bot.start_tasks = [asyncio.create_task(hook()) for hook in bot.start_hooks]
+            max_lag = 0.0
+            async def measure_lag():
+                nonlocal max_lag
+                while True:
+                    start = time.monotonic()
+                    await asyncio.sleep(LAG_INTERVAL)
+                    max_lag = max(max_lag, time.monotonic() - start - LAG_INTERVAL)
+            lag_task = asyncio.create_task(measure_lag())
+            print(f"Replaying {args.servers} servers and {len(subscribed)} subscribed apps for {args.duration} seconds "
+                f"at {args.speed:g}x ({args.duration * args.speed / 3600:.1f} hours)...", flush=True)
+            start = time.time()
+            await bot.on_ready()
+            await asyncio.sleep(args.duration)
+            end = time.time()
+            await bot.close()
+            lag_task.cancel()
+    finally:
+        server.terminate()
+        server.join()
+    seconds = end - start
+    sweeps = program_state.sweeps
+    sweep_seconds = [x[0] for x in sweeps]
+    expected = sum([schedule.count_between(app_id, origin, end) for server in servers.values() for app_id in server.subscribed])
+    delays = discord.delays
+    return {
+        'servers': args.servers,
+        'apps': len(subscribed),
+        'speed': args.speed,
+        'seconds': seconds,
+        'sweeps': len(sweeps),
+        'feeds_checked': sum([x[1] for x in sweeps]),
+        'sweep_seconds_mean': statistics.mean(sweep_seconds) if sweeps else None,
+        'sweep_seconds_p95': percentile(sweep_seconds, 0.95) if sweeps else None,
+        'sweep_seconds_max': max(sweep_seconds) if sweeps else None,
+        'new_items': sum([x[2] for x in sweeps]),
+        'failed_feeds': sum([x[3] for x in sweeps]),
+        'breaker_trips': sum(steambot.metrics.breaker_trips.values.values()),
+        'messages': discord.messages,
+        'embeds': discord.embeds,
+        'items_delivered': len(delays),
+        'items_expected': expected,
+        'items_per_second': len(delays) / seconds,
+        'delivery_seconds_p50': percentile(delays, 0.5),
+        'delivery_seconds_p95': percentile(delays, 0.95),
+        'delivery_seconds_max': max(delays) if delays else None,
+        'max_loop_lag_seconds': max_lag,
+        'peak_rss_bytes': peak_rss(),
+    }
+
+def print_report(report):
+    def value(key, unit=''):
+        x = report[key]
+        return 'n/a' if x is None else f"{x:.3f}{unit}"
+    print(f"Sweeps:           {report['sweeps']} checking {report['feeds_checked']} feeds, {report['failed_feeds']} failed, "
+        f"paused {report['breaker_trips']} times")
+    print(f"Sweep duration:   mean {value('sweep_seconds_mean', ' s')}, p95 {value('sweep_seconds_p95', ' s')}, max {value('sweep_seconds_max', ' s')}")
+    print(f"New items:        {report['new_items']} found, {report['items_delivered']} of {report['items_expected']} posted to servers delivered "
+        f"({report['items_per_second']:.1f}/s) in {report['embeds']} embeds and {report['messages']} messages")
+    print(f"Delivery latency: p50 {value('delivery_seconds_p50', ' s')}, p95 {value('delivery_seconds_p95', ' s')}, max {value('delivery_seconds_max', ' s')}")
+    print(f"Event loop:       lagged at most {value('max_loop_lag_seconds', ' s')}")
+    if report['peak_rss_bytes'] is not None:
+        print(f"Peak RSS:         {report['peak_rss_bytes'] / 2**20:.0f} MiB")
+
+def record(app_ids, directory):
+    # Saves the current feeds of these apps from Steam, to replay them later with --corpus.
+    import requests
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    url = steambot.config.DEFAULT_CONFIG['steam_feed_url']
+    for app_id in app_ids:
+        r = requests.get(url.format(id=app_id), timeout=30)
+        if r.status_code != 200:
+            print(f"#{app_id}: code {r.status_code}, skipped")
+            continue
+        (directory / f'{app_id}.xml').write_bytes(r.content)
+        print(f"#{app_id}: {len(r.content) / 1024:.0f} KiB")
+        time.sleep(1)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.replay',
+        description="Runs the bot's feed loop against a local Steam and fake Discord channels, faster than real time.")
+    actions = parser.add_subparsers(dest='action', required=True)
+    record_parser = actions.add_parser('record', help='Save real feeds from Steam to replay.')
+    record_parser.add_argument('app_ids', nargs='+', type=int, metavar='APP_ID')
+    record_parser.add_argument('-o', '--output', default='corpus', help='Where to save the feeds (default %(default)s).')
+    run_parser = actions.add_parser('run', help='Replay a workload and report how the bot kept up.')
+    run_parser.add_argument('-s', '--servers', type=int, default=1000)
+    run_parser.add_argument('-a', '--apps', type=int, default=2000, help='Apps that post news; servers mostly subscribe to the first ones.')
+    run_parser.add_argument('-d', '--duration', type=float, default=60, help='Seconds to run for (default %(default)s).')
+    run_parser.add_argument('-x', '--speed', type=float, default=3600, help='How much faster than real time apps post and the bot checks them (default %(default)s).')
+    run_parser.add_argument('--corpus', help='A folder of feeds saved with `record`, instead of synthetic ones.')
+    run_parser.add_argument('--latency', type=float, default=0.05, help='Mean seconds the feed server takes to answer (default %(default)s).')
+    run_parser.add_argument('--error-rate', type=float, default=0.01, help='Fraction of feed requests that fail with code 500 (default %(default)s).')
+    run_parser.add_argument('--discord-latency', type=float, default=0.05, help='Mean seconds a message takes to send (default %(default)s).')
+    run_parser.add_argument('--digest-share', type=float, default=0.0, help='Fraction of servers that get digests, every minute of real time.')
+    run_parser.add_argument('--concurrency', type=int, default=steambot.config.DEFAULT_CONFIG['feed_concurrency'], help='Feeds fetched at once.')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--json', metavar='PATH', help='Write the report to this file.')
+    run_parser.add_argument('-v', '--verbose', action='store_true', help="Show the bot's log.")
+    args = parser.parse_args(argv)
+    if args.action == 'record':
+        record(args.app_ids, args.output)
+        return 0
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+    log = logging.getLogger('replay')
+    log.setLevel(logging.INFO if args.verbose else logging.ERROR)
+    report = asyncio.run(replay(args, log))
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(report, fh, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,263 @@
+import argparse
+import asyncio
+import gc
+import json
+import logging
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import steambot.bot
+import steambot.config
+import steambot.feeds
+import steambot.index
+import steambot.search
+import steambot.state
+import steambot.store
+from benchmarks.synthetic import app_names, steam_feed
+
+SERVER_COUNTS = [1000, 10000, 100000]
+APP_COUNT = 200000
+QUICK_SERVER_COUNTS = [1000, 10000]
+QUICK_APP_COUNT = 20000
+# Apps that servers subscribe to; a few popular ones and a long tail.
+SUBSCRIBED_APPS = 20000
+GROUPS = ['feeds', 'apps', 'state']
+# A result is a regression when it is this much slower than the one it is compared to.
+REGRESSION_RATIO = 1.25
+
+class Suite:
+    def __init__(self, repeat, min_seconds):
+        self.repeat = repeat
+        self.min_seconds = min_seconds
+        self.results = {}
+    def time(self, name, func, per_call=1):
+        # Best and median of `repeat` runs, each long enough to not be noise; per_call splits up batched calls.
+        gc.collect()
+        # CPU time rather than wall time, so other processes on the machine don't show up in the results.
+        timer = timeit.Timer(func, timer=time.process_time)
+        number = 1
+        while True:
+            seconds = timer.timeit(number)
+            if seconds >= self.min_seconds:
+                break
+            number *= 2 if seconds * 10 > self.min_seconds else 10
+        times = [seconds] + timer.repeat(self.repeat - 1, number)
+        result = self.results.setdefault(name, {})
+        result['seconds'] = min(times) / number / per_call
+        result['median_seconds'] = statistics.median(times) / number / per_call
+        print(f"{name:52} {_format_seconds(result['seconds']):>10} {_format_seconds(result['median_seconds']):>10}", flush=True)
+    def memory(self, name, func):
+        # Bytes allocated by func that are still in use when it returns, and returns what func returned.
+        gc.collect()
+        tracemalloc.start()
+        try:
+            value = func()
+            (current, peak) = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        result = self.results.setdefault(name, {})
+        result['bytes'] = current
+        result['peak_bytes'] = peak
+        print(f"{name:52} {_format_bytes(current):>10} {_format_bytes(peak):>10} peak", flush=True)
+        return value
+
+def _format_seconds(seconds):
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:.2f} us"
+    if seconds < 1:
+        return f"{seconds * 1e3:.2f} ms"
+    return f"{seconds:.2f} s"
+
+def _format_bytes(size):
+    for unit in ['B', 'KiB', 'MiB']:
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+def synthetic_servers(count, seed=0):
+    rnd = random.Random(seed)
+    servers = {}
+    for i in range(count):
+        id_ = rnd.getrandbits(60)
+        # Most servers post somewhere; the ones that don't still count for saving.
+        channel = rnd.getrandbits(60) if rnd.random() < 0.9 else None
+        subscribed = set([10 * min(int(rnd.paretovariate(0.7)), SUBSCRIBED_APPS) for _ in range(rnd.randint(1, 20))])
+        servers[id_] = steambot.state.Server(f"Server {i}", id_, channel, subscribed)
+    return servers
+
+def synthetic_timestamps(servers, seed=0):
+    rnd = random.Random(seed)
+    app_ids = sorted(set([app_id for server in servers.values() for app_id in server.subscribed]))
+    return dict([(app_id, 1700000000 - rnd.random() * 10**7) for app_id in app_ids])
+
+class UnnamedApps:
+    # Stands in for SteamApps where only the servers matter.
+    def name_from_id(self, app_id):
+        return None
+
+def bench_feeds(suite):
+    config = steambot.config.DEFAULT_CONFIG
+    feed = steam_feed(440, items=20, description_size=5000)
+    newest = max(steambot.feeds.parse(feed)).timestamp()
+    item_tag = ET.fromstring(feed).find('channel/item')
+    item = steambot.feeds.NewsItem.from_tag(item_tag)
+    suite.time('feeds.parse (20 items, 100 KiB)', lambda: steambot.feeds.parse(feed))
+    suite.time('feeds.parse_after (2 new)', lambda: steambot.feeds.parse_after(feed, newest - 86400 * 2))
+    suite.time('feeds.NewsItem.from_tag', lambda: steambot.feeds.NewsItem.from_tag(item_tag))
+    suite.time('bot.blurbify (5000 chars)', lambda: steambot.bot.blurbify(item.description))
+    suite.time('bot.embed_from_feed_item', lambda: steambot.bot.embed_from_feed_item(item, 440, 'Team Fortress 2', config))
+    entries = [(app_id, f"App {app_id}", x) for app_id in range(200) for x in steambot.feeds.parse(steam_feed(app_id, items=3, description_size=100))]
+    suite.time('bot.digest_embeds (600 items)', lambda: steambot.bot.digest_embeds(entries))
+
+def bench_apps(suite, directory, count):
+    log = logging.getLogger('benchmarks')
+    entries = app_names(count)
+    names_path = directory / 'steamapps_names.bin'
+    search_path = directory / 'steamapps_search.bin'
+    start = time.perf_counter()
+    steambot.index.write_name_table(names_path, entries)
+    steambot.search.write_search_index(search_path, entries)
+    print(f"{count} apps written in {time.perf_counter() - start:.1f} s: name table {_format_bytes(names_path.stat().st_size)}, "
+        f"search index {_format_bytes(search_path.stat().st_size)}")
+    # The tables are memory-mapped, so this is only what it takes to open them.
+    apps = suite.memory(f'SteamApps memory ({count} apps)', lambda: steambot.index.SteamApps(None, names_path, log, search_path))
+    rnd = random.Random(0)
+    sample = rnd.sample(entries, 100)
+    queries = [name for _, name in sample[:50]] + [name[:max(4, len(name) // 2)] for _, name in sample[50:]]
+    app_ids = [appid for appid, _ in rnd.sample(entries, 1000)]
+    def search_all():
+        for query in queries:
+            apps.search_names(query)
+    def name_all():
+        for appid in app_ids:
+            apps.name_from_id(appid)
+    async def search_at_once():
+        # A burst of /steambot add commands.
+        await asyncio.gather(*[apps.search_names_async(query) for query in queries])
+    suite.time(f'SteamApps.search_names ({count} apps)', search_all, len(queries))
+    suite.time(f'SteamApps.search_names_async ({count} apps)', lambda: asyncio.run(search_at_once()), len(queries))
+    suite.time(f'SteamApps.name_from_id ({count} apps)', name_all, len(app_ids))
+    suite.time(f'SteamApps.names_from_ids ({count} apps)', lambda: apps.names_from_ids(app_ids), len(app_ids))
+    apps.close()
+
+def bench_state(suite, directory, count):
+    log = logging.getLogger('benchmarks')
+    servers = synthetic_servers(count)
+    timestamps = synthetic_timestamps(servers)
+    # Loaded from saved data, so the servers count too and not only the index.
+    data = steambot.state.ProgramState(servers, timestamps).serialize()
+    suite.memory(f'ProgramState memory ({count} servers)', lambda: steambot.state.ProgramState.deserialize(steambot.state.STATE_VERSION, data))
+    del data
+    suite.time(f'ProgramState() ({count} servers)', lambda: steambot.state.ProgramState(servers, timestamps))
+    # ProgramState() points the servers at the new instances; point them back.
+    state = steambot.state.ProgramState(servers, timestamps)
+    suite.time(f'ProgramState.get_active_server_feeds ({count} servers)', state.get_active_server_feeds)
+    new_items = [(app_id, [None]) for app_id in list(timestamps)[:100]]
+    suite.time(f'ProgramState.with_servers (100 apps, {count} servers)', lambda: state.with_servers(new_items, UnnamedApps()))
+    config = dict(steambot.config.DEFAULT_CONFIG,
+        state_file=str(directory / f'state-{count}.pickle'),
+        state_database=str(directory / f'state-{count}.sqlite3'))
+    pickle_config = dict(config, state_backend='pickle')
+    state.store = steambot.store.PickleStore(config['state_file'])
+    def save():
+        state.changed = True
+        state.save(pickle_config, log)
+    suite.time(f'ProgramState.save pickle ({count} servers)', save)
+    suite.time(f'ProgramState.load pickle ({count} servers)', lambda: steambot.state.ProgramState.load(pickle_config, log))
+    sqlite_config = dict(config, state_backend='sqlite', state_file=None)
+    store = steambot.store.SqliteStore(config['state_database'])
+    with store.connection:
+        store.connection.executemany("INSERT INTO servers (id, name, channel) VALUES (?, ?, ?)",
+            [(s.id, s.name, s.channel) for s in servers.values()])
+        store.connection.executemany("INSERT INTO subscriptions VALUES (?, ?)",
+            [(s.id, app_id) for s in servers.values() for app_id in s.subscribed])
+        store.connection.executemany("INSERT INTO feeds (app_id, timestamp) VALUES (?, ?)", timestamps.items())
+    store.close()
+    suite.time(f'ProgramState.load sqlite ({count} servers)', lambda: steambot.state.ProgramState.load(sqlite_config, log).store.close())
+
+def peak_rss():
+    try:
+        import resource
+    except ImportError:
+        # Not on Windows.
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+def compare(results, baseline, ratio):
+    # Prints how each result changed, and returns the names of the ones that got slower than ratio allows.
+    print(f"\n{'compared to baseline':52} {'before':>10} {'after':>10} {'change':>8}")
+    regressions = []
+    for name, result in results.items():
+        before = baseline.get(name, {})
+        for key, format_value in [('seconds', _format_seconds), ('bytes', _format_bytes)]:
+            if key not in result or not before.get(key):
+                continue
+            change = result[key] / before[key]
+            flag = ''
+            if change > ratio:
+                flag = ' !'
+                regressions.append(f"{name} ({key})")
+            print(f"{name:52} {format_value(before[key]):>10} {format_value(result[key]):>10} {change:7.2f}x{flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+        description="Times the bot's hot paths on synthetic data and measures their memory use.")
+    parser.add_argument('--quick', action='store_true', help='Smaller data and fewer repeats, for a quick check.')
+    parser.add_argument('--only', action='append', choices=GROUPS, help='Only run these groups of benchmarks.')
+    parser.add_argument('--repeat', type=int, help='How many times to time each benchmark (default 5, or 3 with --quick).')
+    parser.add_argument('--json', metavar='PATH', help='Write the results to this file.')
+    parser.add_argument('--compare', metavar='PATH', help='Compare with the results of an earlier run, and fail if anything got slower.')
+    parser.add_argument('--ratio', type=float, default=REGRESSION_RATIO, help='How much slower counts as a regression (default %(default)s).')
+    args = parser.parse_args(argv)
+    groups = args.only or GROUPS
+    if args.quick:
+        suite = Suite(repeat=args.repeat or 3, min_seconds=0.05)
+        (server_counts, app_count) = (QUICK_SERVER_COUNTS, QUICK_APP_COUNT)
+    else:
+        suite = Suite(repeat=args.repeat or 5, min_seconds=0.2)
+        (server_counts, app_count) = (SERVER_COUNTS, APP_COUNT)
+    print(f"{'benchmark':52} {'best':>10} {'median':>10}")
+    if 'feeds' in groups:
+        bench_feeds(suite)
+    with tempfile.TemporaryDirectory() as directory:
+        directory = Path(directory)
+        if 'apps' in groups:
+            bench_apps(suite, directory, app_count)
+        if 'state' in groups:
+            for count in server_counts:
+                bench_state(suite, directory, count)
+    output = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'quick': args.quick,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'peak_rss_bytes': peak_rss(),
+        'results': suite.results,
+    }
+    if output['peak_rss_bytes'] is not None:
+        print(f"Peak RSS: {_format_bytes(output['peak_rss_bytes'])}")
+    if args.json:
+        with open(args.json, 'w') as fh:
+            json.dump(output, fh, indent=2)
+    if args.compare:
+        with open(args.compare, 'r') as fh:
+            baseline = json.load(fh)
+        if baseline.get('quick') != args.quick:
+            print("Warning: comparing a --quick run with a full one")
+        regressions = compare(suite.results, baseline['results'], args.ratio)
+        if regressions:
+            print(f"{len(regressions)} regressions: {', '.join(regressions)}")
+            return 1
+    return 0
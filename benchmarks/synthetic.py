@@ -0,0 +1,63 @@
+import email.utils
+import json
+import random
+
+WORDS = ['patch', 'update', 'fixed', 'crash', 'multiplayer', 'balance', 'weapon', 'server', 'performance',
+    'improved', 'new', 'map', 'quest', 'event', 'season', 'bug', 'players', 'the', 'and', 'with', 'for']
+
+def html_description(rnd, size):
+    parts = []
+    length = 0
+    while length < size:
+        words = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(8, 30)))
+        part = f'<p>{words} &amp; <b>{rnd.choice(WORDS)}</b></p><ul><li>{words}</li></ul><br>'
+        if rnd.random() < 0.1:
+            part += f'<img src="https://clan.cloudflare.steamstatic.com/images/{rnd.randint(1, 10**6)}.png">'
+        parts.append(part)
+        length += len(part)
+    return ''.join(parts)
+
+def steam_feed(app_id, items=20, description_size=5000, newest=1700000000, gap=86400, seed=0):
+    rnd = random.Random(seed * 1000003 + app_id)
+    item_tags = []
+    for i in range(items):
+        date = email.utils.formatdate(newest - i * gap, usegmt=True).replace('GMT', '+0000')
+        link = f'https://store.steampowered.com/news/app/{app_id}/view/{3000000000000000000 + i}'
+        item_tags.append(
+            f'<item><title>{" ".join(rnd.choice(WORDS) for _ in range(5)).title()}</title>'
+            f'<description><![CDATA[{html_description(rnd, description_size)}]]></description>'
+            f'<link>{link}</link><guid isPermaLink="true">{link}</guid><pubDate>{date}</pubDate>'
+            f'<author>Developer</author><enclosure url="https://clan.cloudflare.steamstatic.com/images/{app_id}/{i}.jpg" length="0" type="image/jpeg" />'
+            f'</item>')
+    return (f'<?xml version="1.0" encoding="UTF-8"?><rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom">'
+        f'<channel><title>App {app_id} RSS Feed</title><link>https://store.steampowered.com/news/app/{app_id}</link>'
+        f'<description>Steam News Feed</description><language>en-us</language>{"".join(item_tags)}</channel></rss>').encode('utf-8')
+
+def steam_news_json(app_id, items=5, maxlength=600, newest=1700000000, gap=86400, seed=0):
+    # What ISteamNews/GetNewsForApp returns for the same items as steam_feed, shortened to maxlength.
+    rnd = random.Random(seed * 1000003 + app_id)
+    news_items = []
+    for i in range(items):
+        link = f'https://steamstore-a.akamaihd.net/news/externalpost/steam_community_announcements/{3000000000000000000 + i}'
+        words = ' '.join(rnd.choice(WORDS) for _ in range(maxlength // 6))
+        news_items.append({'gid': str(3000000000000000000 + i), 'title': ' '.join(rnd.choice(WORDS) for _ in range(5)).title(),
+            'url': link, 'is_external_url': True, 'author': 'Developer', 'contents': words[:maxlength - 3] + '...',
+            'feedlabel': 'Community Announcements', 'date': newest - i * gap, 'feedname': 'steam_community_announcements',
+            'feed_type': 1, 'appid': app_id})
+    return json.dumps({'appnews': {'appid': app_id, 'newsitems': news_items, 'count': 100}}).encode('utf-8')
+
+NAME_WORDS = ['the', 'of', 'and', 'simulator', 'vr', 'edition', 'soundtrack', 'dlc', 'pack', 'remastered', 'online',
+    'tactics', 'legends', 'chronicles', 'adventure', 'dungeon', 'space', 'zombie', 'racing', 'war', '2', '3', 'ii']
+SYLLABLES = [c + v + e for c in 'bcdfghklmnprstvwz' for v in 'aeiou' for e in ['', '', 'n', 'r', 'x']]
+
+def app_names(count, seed=0):
+    # Made-up words with a sprinkling of the common ones, shaped roughly like Steam's app list.
+    rnd = random.Random(seed)
+    words = sorted(set(''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4))) for _ in range(count // 4)))
+    entries = []
+    for appid in range(10, 10 + count * 10, 10):
+        parts = [rnd.choice(words).title() for _ in range(rnd.randint(1, 3))]
+        while rnd.random() < 0.4:
+            parts.insert(rnd.randint(0, len(parts)), rnd.choice(NAME_WORDS).title())
+        entries.append((appid, ' '.join(parts)))
+    return entries
@@ -1,13 +1,93 @@
+from collections import OrderedDict
+from html.parser import HTMLParser
+from pathlib import Path
+import asyncio
+import functools
+import json
+import re
+import signal
 import discord
 from discord.utils import escape_markdown as escape
 from discord.ext import tasks
-from bs4 import BeautifulSoup
+
+import steambot.complete
+import steambot.delivery
+import steambot.diagnostics
+import steambot.feeds
+import steambot.metrics
+import steambot.schedule
+import steambot.spool
+import steambot.state
+
+SPOOL_CONSUMER = 'bot'
+BLURB_LENGTH = 400
+BLURB_CHUNK_SIZE = 1024
+DIGEST_TITLE_LENGTH = 200
+
+class BlurbExtractor(HTMLParser):
+    # Collects text like BeautifulSoup's get_text(' '), but stops as soon as it has enough.
+    ASCII_SPACES = str.maketrans('', '', '\x20\x0a\x09\x0c\x0d')
+    class Enough(Exception):
+        pass
+    def __init__(self, limit):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.strings = []
+        self.length = 0
+        self.in_string = False
+        self.in_script = False
+    def _end_string(self):
+        if not self.in_string:
+            return
+        self.in_string = False
+        string = self.strings[-1]
+        if not string.translate(self.ASCII_SPACES):
+            # BeautifulSoup collapses whitespace between tags.
+            string = self.strings[-1] = '\n' if '\n' in string else ' '
+        self.length += len(string) + 1
+    def _add_string(self, data):
+        if self.in_string:
+            self.strings[-1] += data
+        else:
+            self.strings.append(data)
+            self.in_string = True
+        if self.length + len(self.strings[-1]) > self.limit and self.strings[-1].translate(self.ASCII_SPACES):
+            raise BlurbExtractor.Enough()
+    def handle_data(self, data):
+        if not self.in_script:
+            self._add_string(data)
+    def unknown_decl(self, data):
+        self._end_string()
+        if data.startswith('CDATA['):
+            self._add_string(data[6:])
+            self._end_string()
+    def handle_starttag(self, tag, attrs):
+        self._end_string()
+        self.in_script = tag in ('script', 'style')
+    def handle_endtag(self, tag):
+        self._end_string()
+        self.in_script = False
+    def handle_comment(self, data):
+        self._end_string()
+    def handle_decl(self, decl):
+        self._end_string()
+    def handle_pi(self, data):
+        self._end_string()
+    def text(self):
+        self._end_string()
+        return ' '.join(self.strings)
 
 def blurbify(markup):
-    soup = BeautifulSoup(markup, features="html.parser")
-    text = soup.get_text(' ')
-    if len(text) > 400:
-        text = text[:400] + '...'
+    extractor = BlurbExtractor(BLURB_LENGTH)
+    try:
+        for start in range(0, len(markup or ''), BLURB_CHUNK_SIZE):
+            extractor.feed(markup[start:start + BLURB_CHUNK_SIZE])
+        extractor.close()
+    except BlurbExtractor.Enough:
+        pass
+    text = extractor.text()
+    if len(text) > BLURB_LENGTH:
+        text = text[:BLURB_LENGTH] + '...'
     return text
 
 def embed_from_feed_item(item, app_id, app_name, config):
@@ -22,6 +102,118 @@ def embed_from_feed_item(item, app_id, app_name, config):
         embed.set_image(url=item.image)
     return embed
 
+def digest_lines(entries):
+    apps = {}
+    for app_id, app_name, item in entries:
+        apps.setdefault((app_id, app_name), []).append(item)
+    lines = []
+    for (app_id, app_name), items in apps.items():
+        lines.append(f"**{escape(app_name)}** (#{app_id})")
+        for item in sorted(items):
+            title = item.title or '<Untitled>'
+            if len(title) > DIGEST_TITLE_LENGTH:
+                title = title[:DIGEST_TITLE_LENGTH] + '...'
+            # Brackets would end the link text early.
+            title = escape(title).replace('[', '(').replace(']', ')')
+            lines.append(f"• [{title}]({item.link}) {item.format_date()}")
+    return lines
+
+def digest_embeds(entries):
+    # Packs the items into as few embeds as fit in as few messages as Discord allows.
+    title = "News digest"
+    embeds = []
+    lines = []
+    length = 0
+    # Characters and embeds left in the message the next embed goes into.
+    room = steambot.delivery.MAX_EMBED_CHARACTERS_PER_MESSAGE
+    slots = steambot.delivery.MAX_EMBEDS_PER_MESSAGE
+    def add_embed():
+        nonlocal lines, length, room, slots
+        embeds.append(discord.Embed(title=title, description='\n'.join(lines), color=discord.Colour.fuchsia()))
+        room -= len(title) + length
+        slots -= 1
+        lines = []
+        length = 0
+    for line in digest_lines(entries):
+        # Always fits in an embed of its own.
+        line = line[:steambot.delivery.MAX_EMBED_DESCRIPTION]
+        while True:
+            if not slots:
+                room = steambot.delivery.MAX_EMBED_CHARACTERS_PER_MESSAGE
+                slots = steambot.delivery.MAX_EMBEDS_PER_MESSAGE
+            limit = min(steambot.delivery.MAX_EMBED_DESCRIPTION, room - len(title))
+            needed = len(line) + 1 if lines else len(line)
+            if length + needed <= limit:
+                lines.append(line)
+                length += needed
+                break
+            if lines:
+                add_embed()
+            else:
+                # Doesn't fit in what's left of this message, so it starts the next one.
+                slots = 0
+    if lines:
+        add_embed()
+    return embeds
+
+class EmbedCache:
+    # Rendered embeds by app and item link, so an item is only rendered once, even across restarts.
+    def __init__(self, path, size):
+        self.path = Path(path)
+        self.size = size
+        self.embeds = OrderedDict()
+        self.changed = False
+    def load(self, log):
+        if not self.path.is_file():
+            return
+        try:
+            with open(self.path, 'r') as fh:
+                for key, data in json.load(fh):
+                    self.embeds[key] = discord.Embed.from_dict(data)
+            log.info(f"Embed cache loaded - {len(self.embeds)} entries")
+        except Exception as ex:
+            log.warning(f"Ignoring embed cache: {ex}")
+    def save(self, log):
+        if not self.changed:
+            return
+        data = [(key, embed.to_dict()) for key, embed in self.embeds.items()]
+        with steambot.state.AtomicBinaryFile(self.path, prefix='embeds_') as fh:
+            fh.write(json.dumps(data).encode('utf-8'))
+        self.changed = False
+        log.debug(f"Embed cache saved - {len(data)} entries")
+    def get(self, item, app_id, app_name, config):
+        key = f"{app_id} {item.link}"
+        embed = self.embeds.get(key)
+        if embed is not None:
+            self.embeds.move_to_end(key)
+            return embed
+        embed = self.embeds[key] = embed_from_feed_item(item, app_id, app_name, config)
+        while len(self.embeds) > self.size:
+            self.embeds.popitem(last=False)
+        self.changed = True
+        return embed
+
+class Hooks:
+    # start_hooks run next to connecting to Discord, close_hooks run once before disconnecting.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.start_hooks = []
+        self.start_tasks = []
+        self.close_hooks = []
+    async def start(self, *args, **kwargs):
+        self.start_tasks = [asyncio.create_task(hook()) for hook in self.start_hooks]
+        await super().start(*args, **kwargs)
+    async def close(self):
+        while self.close_hooks:
+            await self.close_hooks.pop(0)()
+        await super().close()
+
+class SteamBot(Hooks, discord.Bot):
+    pass
+
+class ShardedSteamBot(Hooks, discord.AutoShardedBot):
+    pass
+
 async def send_button_message(ctx, message, options, callback, **args):
     class ButtonView(discord.ui.View):
         async def on_timeout(self):
@@ -38,10 +230,59 @@ async def send_button_message(ctx, message, options, callback, **args):
         pass
     await ctx.respond(message, view=ButtonView2(timeout=120), **args)
 
-def create_bot(program_state, steam_app_list, config, log):
+def create_bot(load, config, log, shard_ids=None, shard_count=None):
+    # load() returns (program_state, steam_app_list); it runs in a thread while the bot connects.
     steamnewsgroup = discord.SlashCommandGroup(config['bot_name'].lower(), f"Commands for the {config['bot_name']} bot.")
-    bot = discord.Bot()
+    if shard_ids is None and shard_count is None:
+        bot = SteamBot()
+        spool_consumer = SPOOL_CONSUMER
+    else:
+        bot = ShardedSteamBot(shard_ids=shard_ids, shard_count=shard_count)
+        # Every process reads the whole spool and posts to its own guilds.
+        spool_consumer = SPOOL_CONSUMER if shard_ids is None else f"{SPOOL_CONSUMER}-{shard_ids[0]}-{shard_ids[-1]}"
     bot.add_application_command(steamnewsgroup)
+    feed_fetcher = steambot.feeds.FeedFetcher(config, log)
+    bot.close_hooks.append(feed_fetcher.close)
+    feed_scheduler = steambot.schedule.FeedScheduler(config)
+    delivery = steambot.delivery.DeliveryQueue(bot.get_channel, bot.fetch_channel, config, log)
+    bot.close_hooks.append(delivery.close)
+    embed_cache = EmbedCache(config['embed_cache_file'], config['embed_cache_size'])
+    embed_cache.load(log)
+    spool = None
+    spool_reader = None
+    if config['feed_mode'] == 'poller':
+        # A separate `steambot poller` process fetches the feeds.
+        spool = steambot.spool.Spool(config['spool_database'])
+        spool_reader = steambot.spool.SpoolReader(spool, spool_consumer)
+    program_state = None
+    steam_app_list = None
+    loaded = asyncio.Event()
+    app_completer = None
+    metrics_runner = None
+    loop_lag_task = None
+    watchdog = None
+    if config['stall_threshold_seconds'] is not None:
+        watchdog = steambot.diagnostics.LoopWatchdog(config['stall_threshold_seconds'], log)
+    profiler = steambot.diagnostics.Profiler(config['profile_dir'], log)
+
+    async def load_in_background():
+        nonlocal program_state, steam_app_list
+        try:
+            (program_state, steam_app_list) = await asyncio.get_running_loop().run_in_executor(None, load)
+        except Exception as ex:
+            log.critical(f"Couldn't load the state and Steam apps: {ex}")
+            await bot.close()
+            return
+        loaded.set()
+    bot.start_hooks.append(load_in_background)
+
+    async def wait_until_loaded(ctx, ephemeral):
+        if not loaded.is_set():
+            # Discord gives up on commands that aren't answered within 3 seconds.
+            # The reply after a defer is only visible to whoever the defer was, so
+            # each command defers the way its reply will be shown.
+            await ctx.defer(ephemeral=ephemeral)
+            await loaded.wait()
 
     def _authorized(ctx):
         guild = ctx.guild
@@ -63,14 +304,13 @@ def create_bot(program_state, steam_app_list, config, log):
         if channel_was_set:
             msg += "\nPosting news in this channel."
         await response_func(msg)
-        if appid not in program_state.timestamps:
-            update_feeds.restart()
 
     @steamnewsgroup.command(description="Tell the bot to post here.")
     async def posthere(ctx):
         if not _authorized(ctx):
             await ctx.respond("Only the server owner can use this command.")
             return
+        await wait_until_loaded(ctx, False)
         server = program_state.get_server(ctx, log)
         if not server:
             await ctx.respond("This is not a server!")
@@ -91,6 +331,7 @@ def create_bot(program_state, steam_app_list, config, log):
         if not _authorized(ctx):
             await ctx.respond("Only the server owner can use this command.")
             return
+        await wait_until_loaded(ctx, True)
         server = program_state.get_server(ctx, log)
         if not server:
             await ctx.respond("This is not a server!")
@@ -103,12 +344,34 @@ def create_bot(program_state, steam_app_list, config, log):
         await bot.get_channel(server.channel).send("No longer posting to this channel.")
         server.set_channel(None)
 
+    async def _complete_app_name(ctx):
+        if app_completer is None:
+            return []
+        choices = []
+        appids = app_completer.complete(ctx.value or '', program_state.subscriber_count)
+        names = await steam_app_list.names_from_ids_async(appids)
+        for appid in appids:
+            name = names[appid] or '<Unnamed>'
+            suffix = f" (#{appid})"
+            if len(name) + len(suffix) > 100:
+                name = name[:97 - len(suffix)] + '...'
+            choices.append(discord.OptionChoice(name=name + suffix, value=f"#{appid}"))
+        return choices
+
     @steamnewsgroup.command(description="Add a Steam game to the news feed.")
-    async def add(ctx, name: str):
+    async def add(ctx, name: discord.Option(str, "The name of the game.", autocomplete=_complete_app_name)):
         if not _authorized(ctx):
             await ctx.respond("Only the server owner can use this command.")
             return
-        matches = steam_app_list.search_names(name)
+        await wait_until_loaded(ctx, True)
+        chosen = re.fullmatch(r'#(\d+)', name.strip())
+        if chosen:
+            # Picked from the autocomplete suggestions.
+            appid = int(chosen.group(1))
+            chosen_name = await steam_app_list.name_from_id_async(appid)
+            matches = [(appid, chosen_name)] if chosen_name else []
+        else:
+            matches = await steam_app_list.search_names_async(name)
         if len(matches) == 0:
             await ctx.respond(f"Sorry, I couldn't find *{escape(name)}*!", ephemeral=True)
         elif len(matches) > 1:
@@ -121,12 +384,44 @@ def create_bot(program_state, steam_app_list, config, log):
             appid, name = matches[0]
             await _do_add(ctx, ctx.respond, appid, name)
 
+    @steamnewsgroup.command(description="Post the news every so often as a digest, instead of item by item.")
+    async def digest(ctx, minutes: discord.Option(int, "How long to collect news for; 0 posts every item right away again.",
+            min_value=0, max_value=1440)):
+        if not _authorized(ctx):
+            await ctx.respond("Only the server owner can use this command.")
+            return
+        await wait_until_loaded(ctx, True)
+        server = program_state.get_server(ctx, log)
+        if not server:
+            await ctx.respond("This is not a server!")
+            return
+        server.set_digest(minutes or None)
+        log.info(f'"{server.name}" (#{server.id}) set digest to {minutes} minutes')
+        if minutes:
+            await ctx.respond(f"Ok! Posting the news as a digest every {minutes} minutes.", ephemeral=True)
+        else:
+            await ctx.respond("Ok! Posting the news as it comes in.", ephemeral=True)
+
+    @steamnewsgroup.command(description="Profile the bot for a while (bot owner only).")
+    async def profile(ctx, seconds: discord.Option(int, "How long to profile for.", min_value=1, max_value=600, default=30)):
+        if not await bot.is_owner(ctx.user):
+            await ctx.respond("Only the owner of the bot can use this command.", ephemeral=True)
+            return
+        if profiler.running:
+            await ctx.respond("Already profiling.", ephemeral=True)
+            return
+        await ctx.respond(f"Profiling for {seconds} seconds...", ephemeral=True)
+        path = await profiler.profile(seconds)
+        if path is not None:
+            await ctx.followup.send(f"Profile written to `{path}`.", ephemeral=True)
+
     @steamnewsgroup.command(description="Add a Steam game by ID to the news feed.")
     async def addid(ctx, appid: int):
         if not _authorized(ctx):
             await ctx.respond("Only the server owner can use this command.")
             return
-        name = steam_app_list.name_from_id(appid)
+        await wait_until_loaded(ctx, True)
+        name = await steam_app_list.name_from_id_async(appid)
         if not name:
             await ctx.respond(f"Sorry! I don't think #{appid} is valid.", ephemeral=True)
         else:
@@ -135,13 +430,16 @@ def create_bot(program_state, steam_app_list, config, log):
 
     @steamnewsgroup.command(description="List all news feeds.")
     async def list(ctx):
+        await wait_until_loaded(ctx, True)
         server = program_state.get_server(ctx, log)
         if not server:
             await ctx.respond("This is not a server!")
             return
         lines = ["This server is subscribed to the following feeds:"]
-        for appid in server.subscribed:
-            name = steam_app_list.name_from_id(appid) or '<Unnamed>'
+        # All the names in one go, rather than a trip to the thread pool for each.
+        names = await steam_app_list.names_from_ids_async(server.subscribed)
+        for appid, name in names.items():
+            name = name or '<Unnamed>'
             lines.append(f"  • *{escape(name)}* (#{appid})")
         if server.channel is not None:
             channel_name = bot.get_channel(server.channel).name
@@ -156,11 +454,12 @@ def create_bot(program_state, steam_app_list, config, log):
         if not _authorized(ctx):
             await ctx.respond("Only the server owner can use this command.")
             return
+        await wait_until_loaded(ctx, True)
         server = program_state.get_server(ctx, log)
         if not server:
             await ctx.respond("This is not a server!")
             return
-        name = steam_app_list.name_from_id(appid) or '<Unnamed>'
+        name = await steam_app_list.name_from_id_async(appid) or '<Unnamed>'
         was_removed = server.remove_feed(appid)
         if not was_removed:
             await ctx.respond(f"You're not subscribed to *{escape(name)}* (#{appid}).", ephemeral=True)
@@ -175,6 +474,7 @@ def create_bot(program_state, steam_app_list, config, log):
         if not _authorized(ctx):
             await ctx.respond("Only the server owner can use this command.")
             return
+        await wait_until_loaded(ctx, True)
         server = program_state.get_server(ctx, log)
         if not server:
             await ctx.respond("This is not a server!")
@@ -186,25 +486,121 @@ def create_bot(program_state, steam_app_list, config, log):
 
     @bot.event
     async def on_ready():
+        nonlocal metrics_runner, loop_lag_task
+        if metrics_runner is None and config['metrics_port'] is not None:
+            metrics_runner = await steambot.metrics.serve(config, log)
+            loop_lag_task = asyncio.create_task(steambot.metrics.measure_loop_lag())
+        if watchdog is not None:
+            watchdog.start()
+        if hasattr(signal, 'SIGUSR1'):
+            # `kill -USR1 <pid>` profiles the bot without going through Discord.
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1,
+                lambda: asyncio.create_task(profiler.profile(config['profile_seconds'])))
+        delivery.start()
+        report_delivery.start()
+        await loaded.wait()
         save_state.start()
         update_feeds.start()
+        report_quarantine.start()
+        post_digests.start()
+        refresh_completer.start()
         log.info("Bot is running. Press Ctrl+C to exit.")
 
-    @tasks.loop(seconds=config['seconds_between_updates'])
+    @tasks.loop(seconds=config['scheduler_tick_seconds'])
     async def update_feeds():
-        servers_new_items = program_state.check_feeds(steam_app_list, config, log)
+        # An exception would stop the loop for good, so it's only logged and the next tick tries again.
+        try:
+            if spool is None:
+                _post_new_items(await program_state.check_feeds(feed_fetcher, steam_app_list, config, log, feed_scheduler))
+                return
+            (new_items, batch) = spool_reader.read()
+            if batch is None:
+                return
+            # Acknowledged once all of it is posted, so a restart before then reads it again.
+            spool_reader.hold(batch)
+            try:
+                _post_new_items(program_state.with_servers(new_items, steam_app_list), batch)
+            finally:
+                spool_reader.release(batch)
+        except Exception as ex:
+            log.warning(f"Error checking feeds: {ex}")
+
+    def _post_new_items(servers_new_items, batch=None):
         if not servers_new_items:
             return
         log.info(f"Posting {len(servers_new_items)} new updates.")
+        steambot.metrics.new_items.inc(amount=sum([len(x[3]) for x in servers_new_items]))
         for servers, app_id, app_name, new_items in servers_new_items:
-            embeds = [embed_from_feed_item(x, app_id, app_name, config) for x in new_items]
+            embeds = None
             for server in servers:
-                channel = bot.get_channel(server.channel)
-                for embed in embeds:
-                    await channel.send(embed=embed)
+                if server.digest_minutes is not None:
+                    program_state.digests.add(server, app_id, app_name, new_items)
+                    continue
+                if embeds is None:
+                    embeds = [embed_cache.get(x, app_id, app_name, config) for x in new_items]
+                done = None
+                if batch is not None:
+                    spool_reader.hold(batch)
+                    done = lambda delivered: spool_reader.release(batch)
+                delivery.enqueue(server, embeds, done)
+
+    @tasks.loop(seconds=60)
+    async def post_digests():
+        for server, last_id, entries in program_state.digests.due():
+            # Only forgotten once posted, so a restart before then posts them again.
+            delivery.enqueue(server, digest_embeds(entries), functools.partial(program_state.digests.posted, server, last_id))
+
+    @tasks.loop(seconds=60)
+    async def report_delivery():
+        delivery.report()
+
+    @tasks.loop(hours=1)
+    async def report_quarantine():
+        if spool is None:
+            # Otherwise the pollers keep track of failing feeds.
+            program_state.report_quarantine(config, log, steam_app_list)
+
+    @tasks.loop(seconds=600)
+    async def refresh_completer():
+        nonlocal app_completer
+        names = steam_app_list.current_names()
+        if names is not None and (app_completer is None or app_completer.version != names.version):
+            log.info("Building autocomplete index...")
+            loop = asyncio.get_running_loop()
+            app_completer = await loop.run_in_executor(None, steambot.complete.AppCompleter.build, names, names.version)
+            log.info(f"Autocomplete index built - {len(app_completer)} entries")
+        if app_completer is not None:
+            app_completer.set_popular(program_state.get_active_server_feeds(), program_state.subscriber_count)
 
     @tasks.loop(seconds=300)
     async def save_state():
         program_state.save(config, log)
+        embed_cache.save(log)
+
+    async def close_steam_app_list():
+        if steam_app_list is not None:
+            steam_app_list.close()
+    bot.close_hooks.append(close_steam_app_list)
+
+    async def save_embed_cache():
+        embed_cache.save(log)
+    bot.close_hooks.append(save_embed_cache)
+
+    async def stop_metrics():
+        if watchdog is not None:
+            watchdog.stop()
+        if loop_lag_task is not None:
+            loop_lag_task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+    bot.close_hooks.append(stop_metrics)
+
+    async def save_state_on_exit():
+        if program_state is None:
+            return
+        log.info("Saving state before exit...")
+        program_state.save(config, log)
+        program_state.store.close()
+    bot.close_hooks.append(save_state_on_exit)
 
     return bot
@@ -0,0 +1,122 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import functools
+import heapq
+import re
+
+NON_WORD = re.compile(r'[\W_]+')
+# Discord shows at most this many suggestions.
+MAX_CHOICES = 25
+# Matches gathered per query before ranking.
+MAX_CANDIDATES = 1000
+# The most followed apps, which are checked on their own when a query has too many matches to gather them all.
+POPULAR_APPS = 1000
+CACHE_SIZE = 4096
+# Only the start of each suffix is used for sorting, matching never looks further.
+SORT_KEY_LENGTH = 48
+
+# Ranked best first.
+EXACT, NAME_PREFIX, WORD_PREFIX = range(3)
+
+def normalize(name):
+    return NON_WORD.sub(' ', name.casefold()).strip()
+
+class AppCompleter:
+    # Every word of every normalized name starts a suffix, and the suffixes are kept sorted,
+    # so the names containing a word starting with the query are one contiguous range.
+    # The entries must be sorted by appid, like the name table.
+    @classmethod
+    def build(Cls, entries, version=None):
+        appids = array('I')
+        starts = array('I')
+        suffixes = array('I')
+        blob = bytearray()
+        for appid, name in entries:
+            normalized = normalize(name or '').encode('utf-8')
+            if not normalized:
+                continue
+            start = len(blob)
+            appids.append(appid)
+            starts.append(start)
+            suffixes.append(start)
+            for pos, byte in enumerate(normalized):
+                if byte == 0x20:
+                    suffixes.append(start + pos + 1)
+            blob += normalized + b'\n'
+        blob = bytes(blob)
+        suffixes = array('I', sorted(suffixes, key=lambda o: blob[o:o + SORT_KEY_LENGTH]))
+        return Cls(appids, starts, suffixes, blob, version)
+    def __init__(self, appids, starts, suffixes, blob, version=None):
+        self.appids = appids
+        self.starts = starts
+        self.suffixes = suffixes
+        self.blob = blob
+        self.version = version
+        # Documents of the most followed apps.
+        self.popular = ()
+        self.candidates = functools.lru_cache(maxsize=CACHE_SIZE)(self._find_candidates)
+    def __len__(self):
+        return len(self.appids)
+    def set_popular(self, app_ids, popularity):
+        docs = []
+        for app_id in heapq.nlargest(POPULAR_APPS, app_ids, key=popularity):
+            doc = bisect_left(self.appids, app_id)
+            if doc < len(self.appids) and self.appids[doc] == app_id:
+                docs.append(doc)
+        self.popular = tuple(docs)
+        self.candidates.cache_clear()
+    def _lower_bound(self, key):
+        (low, high) = (0, len(self.suffixes))
+        while low < high:
+            middle = (low + high) // 2
+            offset = self.suffixes[middle]
+            if self.blob[offset:offset + len(key)] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+    def _find_candidates(self, query):
+        # Returns [(quality, name length, appid)], without popularity since that changes all the time.
+        key = normalize(query).encode('utf-8')
+        if not key:
+            return ()
+        # Suffixes are only sorted by their start, so longer queries are checked in full.
+        sorted_key = key[:SORT_KEY_LENGTH]
+        found = {}
+        for index in range(self._lower_bound(sorted_key), len(self.suffixes)):
+            offset = self.suffixes[index]
+            if self.blob[offset:offset + len(sorted_key)] != sorted_key:
+                break
+            if self.blob[offset:offset + len(key)] != key:
+                continue
+            doc = bisect_right(self.starts, offset) - 1
+            if offset != self.starts[doc]:
+                quality = WORD_PREFIX
+            elif self.blob[offset + len(key):offset + len(key) + 1] == b'\n':
+                quality = EXACT
+            else:
+                quality = NAME_PREFIX
+            found[doc] = min(quality, found.get(doc, quality))
+            if len(found) >= MAX_CANDIDATES:
+                # The rest are cut off alphabetically, so make sure the popular ones aren't.
+                self._add_popular(key, found)
+                break
+        return tuple((quality, self._length(doc), self.appids[doc]) for doc, quality in found.items())
+    def _add_popular(self, key, found):
+        for doc in self.popular:
+            if doc in found:
+                continue
+            name = self.blob[self.starts[doc]:self.starts[doc] + self._length(doc)]
+            if name == key:
+                found[doc] = EXACT
+            elif name.startswith(key):
+                found[doc] = NAME_PREFIX
+            elif b' ' + key in name:
+                found[doc] = WORD_PREFIX
+    def _length(self, doc):
+        return self.blob.index(b'\n', self.starts[doc]) - self.starts[doc]
+    def complete(self, query, popularity, limit=MAX_CHOICES):
+        candidates = self.candidates(query.strip())
+        # Exact matches, then the apps that are followed the most, then by how well the rest match.
+        ranked = sorted(candidates, key=lambda c: (c[0] != EXACT, -popularity(c[2]), c[0], c[1], c[2]))
+        return [appid for quality, length, appid in ranked[:limit]]
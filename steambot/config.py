@@ -6,12 +6,46 @@ DEFAULT_CONFIG = {
     'version': 1,
     'bot_name': 'SteamBot',
     'bot_token': TOKEN_PLACEHOLDER,
+    'state_backend': 'pickle',
     'state_file': './state.pickle',
+    'state_database': './state.sqlite3',
     'steam_app_list_url': 'https://api.steampowered.com/ISteamApps/GetAppList/v2/',
+    'feed_source': 'rss',
     'steam_feed_url': 'https://store.steampowered.com/feeds/news/app/{id}',
+    'steam_news_api_url': 'https://api.steampowered.com/ISteamNews/GetNewsForApp/v2/?appid={id}&count={count}&maxlength={maxlength}&feeds=steam_community_announcements&format=json',
+    'steam_news_api_count': 5,
+    'steam_news_api_maxlength': 600,
     'steam_app_icon_url': 'https://cdn.cloudflare.steamstatic.com/steam/apps/{id}/header.jpg',
     'steam_index_dir': './steamapps_index',
+    'steam_names_file': './steamapps_names.bin',
+    'steam_manifest_file': './steamapps_manifest.bin',
+    'steam_search_file': './steamapps_search.bin',
+    'search_backend': 'trigram',
+    'search_threads': 2,
+    'max_removed_app_share': 0.1,
     'seconds_between_updates': 600,
+    'min_seconds_between_updates': 300,
+    'max_seconds_between_updates': 21600,
+    'scheduler_tick_seconds': 10,
+    'feed_mode': 'inline',
+    'spool_database': './spool.sqlite3',
+    'delivery_workers': 16,
+    'delivery_retries': 3,
+    'embed_cache_file': './embed_cache.json',
+    'embed_cache_size': 1000,
+    'feed_concurrency': 32,
+    'feed_timeout_seconds': 30,
+    'feed_failure_backoff_seconds': 600,
+    'max_feed_failure_backoff_seconds': 172800,
+    'quarantine_failures': 5,
+    'breaker_failure_ratio': 0.5,
+    'breaker_pause_seconds': 300,
+    'max_breaker_pause_seconds': 3600,
+    'metrics_host': '127.0.0.1',
+    'metrics_port': None,
+    'stall_threshold_seconds': 1.0,
+    'profile_dir': './profiles',
+    'profile_seconds': 30,
 }
 
 def load_configuration(config_file, log):
@@ -21,5 +55,6 @@ def load_configuration(config_file, log):
             log.info("... doesn't exist, so create it.")
             json.dump(DEFAULT_CONFIG, fh, indent='\t')
     with open(config_file, 'r') as fh:
-        config = json.load(fh)
+        config = dict(DEFAULT_CONFIG)
+        config.update(json.load(fh))
     return config
@@ -0,0 +1,178 @@
+import asyncio
+import collections
+import time
+
+import discord
+
+import steambot.metrics
+
+# Discord's limits for a single message.
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_CHARACTERS_PER_MESSAGE = 6000
+MAX_EMBED_DESCRIPTION = 4096
+# Discord's rate limits: messages per channel, and requests per bot.
+CHANNEL_RATE = (5, 5.0)
+GLOBAL_RATE = (50, 1.0)
+RETRY_DELAY = 2.0
+
+class RateLimit:
+    def __init__(self, count, seconds, clock=time.monotonic):
+        self.count = count
+        self.seconds = seconds
+        self.clock = clock
+        self.sent = collections.deque()
+    def wait_time(self):
+        now = self.clock()
+        while self.sent and self.sent[0] <= now - self.seconds:
+            self.sent.popleft()
+        if len(self.sent) < self.count:
+            return 0
+        return self.sent[0] + self.seconds - now
+    async def acquire(self):
+        delay = self.wait_time()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.wait_time()
+        self.sent.append(self.clock())
+
+class ChannelQueue:
+    def __init__(self, channel_id, server):
+        self.channel_id = channel_id
+        self.server = server
+        self.embeds = collections.deque()
+        # Embeds ever queued, and [first, end, done, delivered] for the enqueue() calls that wait for theirs.
+        self.queued = 0
+        self.callbacks = collections.deque()
+        self.rate_limit = RateLimit(*CHANNEL_RATE)
+    def next_message(self):
+        # As many embeds as fit in one message.
+        embeds = []
+        size = 0
+        while self.embeds and len(embeds) < MAX_EMBEDS_PER_MESSAGE:
+            embed_size = len(self.embeds[0])
+            if embeds and size + embed_size > MAX_EMBED_CHARACTERS_PER_MESSAGE:
+                break
+            embeds.append(self.embeds.popleft())
+            size += embed_size
+        return embeds
+    def finish(self, start, end, delivered):
+        # Embeds start to end were sent or dropped; calls back the enqueue() calls that have none left in the queue.
+        for callback in self.callbacks:
+            if not delivered and callback[0] < end and callback[1] > start:
+                callback[3] = False
+        finished = self.queued - len(self.embeds)
+        while self.callbacks and self.callbacks[0][1] <= finished:
+            (_, _, done, all_delivered) = self.callbacks.popleft()
+            done(all_delivered)
+
+class DeliveryStats:
+    def __init__(self):
+        self.messages = 0
+        self.embeds = 0
+        self.retries = 0
+        self.failed = 0
+        self.since = time.monotonic()
+    def report(self, queued, log):
+        seconds = time.monotonic() - self.since
+        if self.messages or self.failed or queued:
+            log.info(f"Delivered {self.embeds} embeds in {self.messages} messages ({self.messages / seconds:.1f}/s), "
+                f"{self.retries} retries, {self.failed} failed, {queued} embeds queued")
+
+class DeliveryQueue:
+    def __init__(self, get_channel, fetch_channel, config, log):
+        self.get_channel = get_channel
+        self.fetch_channel = fetch_channel
+        self.worker_count = config['delivery_workers']
+        self.retries = config['delivery_retries']
+        self.log = log
+        self.channels = {}
+        self.ready = asyncio.Queue()
+        self.rate_limit = RateLimit(*GLOBAL_RATE)
+        self.stats = DeliveryStats()
+        self.workers = []
+    def __len__(self):
+        return sum([len(c.embeds) for c in self.channels.values()])
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self._work()) for _ in range(self.worker_count)]
+    async def close(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+    def enqueue(self, server, embeds, done=None):
+        # done(delivered) is called once the embeds are sent, or dropped for good (delivered=True), or given up on.
+        channel_id = server.channel
+        if channel_id is None or not embeds:
+            if done is not None:
+                done(True)
+            return
+        queue = self.channels.get(channel_id)
+        if queue is None:
+            queue = self.channels[channel_id] = ChannelQueue(channel_id, server)
+            self.ready.put_nowait(channel_id)
+        queue.embeds.extend(embeds)
+        queue.queued += len(embeds)
+        if done is not None:
+            queue.callbacks.append([queue.queued - len(embeds), queue.queued, done, True])
+    def report(self):
+        self.stats.report(len(self), self.log)
+        self.stats = DeliveryStats()
+    def _fail(self, queue, embeds, reason):
+        # Stop posting to channels that are gone or that we can't post in, so they stop costing requests.
+        self.stats.failed += len(embeds) + len(queue.embeds)
+        queue.embeds.clear()
+        server = queue.server
+        if server.channel == queue.channel_id:
+            self.log.warning(f'"{server.name}" (#{server.id}) muted, can\'t post to channel #{queue.channel_id}: {reason}')
+            server.set_channel(None)
+    async def _send(self, queue, embeds):
+        # Returns False if the embeds could be sent later, True if they are sent or never will be.
+        channel = self.get_channel(queue.channel_id)
+        for attempt in range(self.retries + 1):
+            await queue.rate_limit.acquire()
+            await self.rate_limit.acquire()
+            try:
+                if channel is None:
+                    # Not cached while guilds are unavailable or still loading; only the API can tell that it's gone.
+                    channel = await self.fetch_channel(queue.channel_id)
+                start = time.monotonic()
+                await channel.send(embeds=embeds)
+                steambot.metrics.send_seconds.observe(time.monotonic() - start)
+                steambot.metrics.embeds_sent.inc(amount=len(embeds))
+                self.stats.messages += 1
+                self.stats.embeds += len(embeds)
+                return True
+            except (discord.Forbidden, discord.NotFound) as ex:
+                self._fail(queue, embeds, ex)
+                return True
+            except discord.HTTPException as ex:
+                if ex.status != 429 and ex.status < 500:
+                    self.log.warning(f"Dropped {len(embeds)} embeds for channel #{queue.channel_id}: {ex}")
+                    self.stats.failed += len(embeds)
+                    return True
+                self.stats.retries += 1
+                await asyncio.sleep(RETRY_DELAY * 2 ** attempt)
+        self.log.warning(f"Gave up on {len(embeds)} embeds for channel #{queue.channel_id}")
+        self.stats.failed += len(embeds)
+        return False
+    async def _work(self):
+        while True:
+            channel_id = await self.ready.get()
+            queue = self.channels[channel_id]
+            embeds = queue.next_message()
+            start = queue.queued - len(queue.embeds) - len(embeds)
+            delivered = False
+            try:
+                delivered = await self._send(queue, embeds)
+            except Exception as ex:
+                self.log.warning(f"Error posting to channel #{channel_id}: {ex}")
+            try:
+                queue.finish(start, start + len(embeds), delivered)
+            except Exception as ex:
+                self.log.warning(f"Error after posting to channel #{channel_id}: {ex}")
+            if queue.embeds:
+                # Back of the line, so one busy channel doesn't hold up the rest.
+                self.ready.put_nowait(channel_id)
+            else:
+                del self.channels[channel_id]
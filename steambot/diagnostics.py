@@ -0,0 +1,77 @@
+from pathlib import Path
+import asyncio
+import cProfile
+import sys
+import threading
+import time
+import traceback
+
+class LoopWatchdog:
+    # A thread that logs what the event loop is doing when it hasn't come up for air in a while.
+    def __init__(self, threshold, log):
+        self.threshold = threshold
+        self.log = log
+        self.beat = time.monotonic()
+        self.loop_thread_id = None
+        self.heartbeat_task = None
+        self.stopped = threading.Event()
+        self.thread = None
+    def start(self):
+        if self.thread is not None:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.beat = time.monotonic()
+        self.heartbeat_task = asyncio.create_task(self._heartbeat())
+        self.thread = threading.Thread(target=self._watch, name='LoopWatchdog', daemon=True)
+        self.thread.start()
+    def stop(self):
+        if self.thread is None:
+            return
+        self.heartbeat_task.cancel()
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+    async def _heartbeat(self):
+        while True:
+            self.beat = time.monotonic()
+            await asyncio.sleep(self.threshold / 4)
+    def _watch(self):
+        stalled_since = None
+        while not self.stopped.wait(self.threshold / 4):
+            beat = self.beat
+            blocked = time.monotonic() - beat
+            if blocked > self.threshold and stalled_since != beat:
+                stalled_since = beat
+                frame = sys._current_frames().get(self.loop_thread_id)
+                stack = ''.join(traceback.format_stack(frame)) if frame is not None else '<no stack>\n'
+                self.log.warning(f"Event loop blocked for {blocked:.2f} seconds, currently at:\n{stack.rstrip()}")
+            elif stalled_since is not None and stalled_since != beat:
+                self.log.warning(f"Event loop was blocked for {beat - stalled_since:.2f} seconds")
+                stalled_since = None
+
+class Profiler:
+    # Profiles everything that runs on the event loop for a while and writes the stats to disk.
+    def __init__(self, directory, log):
+        self.directory = Path(directory).absolute()
+        self.log = log
+        self.running = False
+    async def profile(self, seconds):
+        # Returns the path of the written profile, or None if a profile is already being taken.
+        if self.running:
+            return None
+        self.running = True
+        try:
+            self.log.info(f"Profiling for {seconds} seconds...")
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                profiler.disable()
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path = self.directory / time.strftime('profile-%Y%m%d-%H%M%S.prof')
+            profiler.dump_stats(path)
+            self.log.info(f"Profile written to {path}")
+            return path
+        finally:
+            self.running = False
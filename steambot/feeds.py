@@ -1,7 +1,20 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import re
+import time
+import aiohttp
 import dateutil.parser
-import requests
 import xml.etree.ElementTree as ET
 
+import steambot.metrics
+
+RFC822_DATE = re.compile(r'(?:[A-Za-z]{3}, )?(\d{1,2}) ([A-Za-z]{3}) (\d{4}) (\d{2}):(\d{2}):(\d{2}) ([+-]\d{4}|GMT|UTC|UT|Z)$')
+MONTHS = {name: index + 1 for index, name in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'])}
+TIMEZONES = {name: datetime.timezone.utc for name in ['GMT', 'UTC', 'UT', 'Z', '+0000', '-0000']}
+PARSE_CHUNK_SIZE = 16384
+
 def getChildOrNone(tag, child):
 	if tag is None:
 		return None
@@ -19,6 +32,20 @@ def getChildAttributeOrNone(tag, child, attr):
 		return None
 	return child_tag.attrib.get(attr, None)
 
+def parse_date(text):
+	match = RFC822_DATE.match(text)
+	if match is None:
+		return dateutil.parser.parse(text)
+	(day, month, year, hour, minute, second, zone) = match.groups()
+	month = MONTHS.get(month)
+	if month is None:
+		return dateutil.parser.parse(text)
+	tz = TIMEZONES.get(zone)
+	if tz is None:
+		offset = datetime.timedelta(hours=int(zone[1:3]), minutes=int(zone[3:5]))
+		tz = TIMEZONES[zone] = datetime.timezone(-offset if zone[0] == '-' else offset)
+	return datetime.datetime(int(year), month, int(day), int(hour), int(minute), int(second), tzinfo=tz)
+
 class NewsItem:
 	@classmethod
 	def from_tag(Cls, item_tag):
@@ -26,9 +53,14 @@ class NewsItem:
 		link = getChildTextOrNone(item_tag, 'link')
 		description = getChildTextOrNone(item_tag, 'description')
 		date_text = getChildTextOrNone(item_tag, 'pubDate')
-		date = dateutil.parser.parse(date_text)
+		date = parse_date(date_text)
 		image = getChildAttributeOrNone(item_tag, 'enclosure', 'url')
 		return Cls(title, link, description, date, image)
+	@classmethod
+	def from_json(Cls, news_item):
+		# An item from the ISteamNews/GetNewsForApp API, which has no images.
+		date = datetime.datetime.fromtimestamp(news_item['date'], datetime.timezone.utc)
+		return Cls(news_item.get('title'), news_item.get('url'), news_item.get('contents'), date, None)
 	def __init__(self, title, link, description, date, image):
 		self.title = title
 		self.link = link
@@ -37,6 +69,14 @@ class NewsItem:
 		self.image = image
 	def __lt__(self, other):
 		return self.timestamp() < other.timestamp()
+	def serialize(self):
+		date = None if self.date is None else self.date.isoformat()
+		return (self.title, self.link, self.description, date, self.image)
+	@classmethod
+	def deserialize(Cls, data):
+		(title, link, description, date, image) = data
+		date = None if date is None else datetime.datetime.fromisoformat(date)
+		return Cls(title, link, description, date, image)
 	def timestamp(self):
 		if self.date is None:
 			return 0
@@ -48,19 +88,141 @@ class NewsItem:
 		else:
 			return self.date.strftime("%A, %B %d at %H:%M:%S %Z")
 
-def load(app_id, config, log):
-	url = config['steam_feed_url'].format(id=app_id)
-	r = requests.get(url)
-	if 200 <= r.status_code < 300:
-		return parse(r.text)
-	else:
-		log.warning(f"Code {r.status_code} when fetching {url}")
-		return None
+# Returned by FeedFetcher.load when the feed is unchanged since the last poll.
+NOT_MODIFIED = object()
+
+class RssSource:
+	# Steam's RSS feed for an app: all recent items, with their full HTML.
+	def __init__(self, config):
+		self.url = config['steam_feed_url']
+	def url_for(self, app_id, timestamp):
+		return self.url.format(id=app_id)
+	def parse(self, body, timestamp):
+		return parse_after(body, timestamp)
+
+class NewsApiSource:
+	# The ISteamNews/GetNewsForApp API: only the newest few items, already shortened by Steam.
+	def __init__(self, config):
+		self.url = config['steam_news_api_url']
+		self.count = config['steam_news_api_count']
+		self.maxlength = config['steam_news_api_maxlength']
+	def url_for(self, app_id, timestamp):
+		# Only the latest item is posted for a feed that hasn't been seen before.
+		count = 1 if timestamp is None else self.count
+		return self.url.format(id=app_id, count=count, maxlength=self.maxlength)
+	def parse(self, body, timestamp):
+		return parse_news_json_after(body, timestamp)
+
+FEED_SOURCES = {
+	'rss': RssSource,
+	'steam_news_api': NewsApiSource,
+}
+
+def create_feed_source(config):
+	source = FEED_SOURCES.get(config['feed_source'])
+	if source is None:
+		raise Exception(f"Unknown feed_source '{config['feed_source']}', must be one of: {', '.join(FEED_SOURCES)}")
+	return source(config)
+
+class FeedFetcher:
+	def __init__(self, config, log, source=None):
+		self.source = source or create_feed_source(config)
+		self.concurrency = config['feed_concurrency']
+		self.timeout = aiohttp.ClientTimeout(total=config['feed_timeout_seconds'])
+		self.log = log
+		self.session = None
+	def _get_session(self):
+		if self.session is None or self.session.closed:
+			connector = aiohttp.TCPConnector(limit=self.concurrency, ttl_dns_cache=300)
+			self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+		return self.session
+	async def close(self):
+		if self.session is not None:
+			await self.session.close()
+			self.session = None
+	async def load(self, app_id, validator=None, timestamp=None):
+		url = self.source.url_for(app_id, timestamp)
+		(etag, last_modified, digest) = validator or (None, None, None)
+		headers = {}
+		if etag is not None:
+			headers['If-None-Match'] = etag
+		if last_modified is not None:
+			headers['If-Modified-Since'] = last_modified
+		try:
+			start = time.monotonic()
+			try:
+				async with self._get_session().get(url, headers=headers) as r:
+					steambot.metrics.fetch_status.inc(app_id, r.status)
+					if r.status == 304:
+						return (NOT_MODIFIED, validator)
+					if not 200 <= r.status < 300:
+						self.log.warning(f"Code {r.status} when fetching {url}")
+						return (None, validator)
+					body = await r.read()
+					new_digest = hashlib.blake2b(body, digest_size=16).digest()
+					new_validator = (r.headers.get('ETag'), r.headers.get('Last-Modified'), new_digest)
+			finally:
+				# Every fetch counts, including 304s, errors and timeouts.
+				steambot.metrics.fetch_seconds.observe(time.monotonic() - start)
+			if new_digest == digest:
+				# Server ignored the validators, but the feed is the same.
+				return (NOT_MODIFIED, new_validator)
+			# Parsing is CPU-bound, keep it off the event loop.
+			(items, seconds) = await asyncio.get_running_loop().run_in_executor(None, timed_call, self.source.parse, body, timestamp)
+			steambot.metrics.parse_seconds.observe(seconds)
+			return (items, new_validator)
+		except asyncio.TimeoutError:
+			self.log.warning(f"Timed out when fetching {url}")
+		except Exception as ex:
+			self.log.warning(f"Error getting feed #{app_id}: {ex}")
+		steambot.metrics.fetch_errors.inc()
+		return (None, validator)
+	async def load_many(self, app_ids, validators, timestamps):
+		semaphore = asyncio.Semaphore(self.concurrency)
+		async def load_one(app_id):
+			async with semaphore:
+				return (app_id, *await self.load(app_id, validators.get(app_id), timestamps.get(app_id)))
+		return await asyncio.gather(*[load_one(app_id) for app_id in app_ids])
 
 def parse(rss):
 	root = ET.fromstring(rss)
 	item_tags = root.findall('channel/item')
 	return sorted([NewsItem.from_tag(tag) for tag in item_tags])
 
+def iter_items(rss):
+	parser = ET.XMLPullParser(events=('end',))
+	for start in range(0, len(rss), PARSE_CHUNK_SIZE):
+		parser.feed(rss[start:start + PARSE_CHUNK_SIZE])
+		for event, tag in parser.read_events():
+			if tag.tag == 'item':
+				yield NewsItem.from_tag(tag)
+				tag.clear()
+	parser.close()
+
+def parse_after(rss, timestamp=None):
+	if timestamp is None:
+		# Feed not seen before, only get latest item.
+		return sorted(iter_items(rss))[-1:]
+	result = []
+	for item in iter_items(rss):
+		if item.timestamp() <= timestamp:
+			# Steam lists the newest items first, so the rest have been seen.
+			break
+		result.append(item)
+	return sorted(result)
+
+def parse_news_json_after(body, timestamp=None):
+	news_items = json.loads(body)['appnews']['newsitems']
+	items = sorted([NewsItem.from_json(x) for x in news_items])
+	if timestamp is None:
+		return items[-1:]
+	return items_after(items, timestamp)
+
+def timed_call(func, *args):
+	# Timed in the worker thread, so waiting for a free thread doesn't count.
+	start = time.monotonic()
+	result = func(*args)
+	return (result, time.monotonic() - start)
+
 def items_after(items, timestamp):
 	return [x for x in items if x.timestamp() > timestamp]
@@ -1,7 +1,35 @@
 import whoosh.index
 import whoosh.fields
 import whoosh.qparser
+from array import array
+from bisect import bisect_left
 from pathlib import Path
+import asyncio
+import codecs
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import re
+import struct
+import sys
+import threading
+import time
+
+import steambot.search
+import steambot.state
+
+NAME_TABLE_MAGIC = b'SBNAMES1'
+MANIFEST_MAGIC = b'SBMANIF1'
+TABLE_HEADER = struct.Struct('<8s2sxxI')
+TABLE_BYTEORDER = b'le' if sys.byteorder == 'little' else b'be'
+APP_LIST_START = re.compile(r'"apps"\s*:\s*\[')
+APP_LIST_SEPARATOR = re.compile(r'[\s,]*')
+# An entry that doesn't parse with this much text after it is malformed, not cut off by the chunk boundary.
+MAX_APP_ENTRY_SIZE = 65536
+# How often the bot checks whether `steambot index` wrote a new name table and search index.
+NAME_TABLE_CHECK_SECONDS = 60
+SEARCH_BACKENDS = ('trigram', 'whoosh')
 
 def create_steamapp_index(config):
     indexdir = Path(config['steam_index_dir'])
@@ -12,28 +40,272 @@ def create_steamapp_index(config):
         schema = whoosh.fields.Schema(appid=whoosh.fields.NUMERIC(stored=True, unique=True), name=whoosh.fields.TEXT(stored=True))
         return whoosh.index.create_in(indexdir, schema)
 
+def write_name_table(path, entries):
+    # Layout: header, sorted uint32 appids, uint32 offsets (one extra for the end), UTF-8 names.
+    appids = array('I')
+    offsets = array('I', [0])
+    names = bytearray()
+    for appid, name in entries:
+        if appids and appid <= appids[-1]:
+            raise ValueError("Name table entries must be sorted by unique appid")
+        appids.append(appid)
+        names += (name or '').encode('utf-8')
+        offsets.append(len(names))
+    with steambot.state.AtomicBinaryFile(path, prefix='names_') as fh:
+        fh.write(TABLE_HEADER.pack(NAME_TABLE_MAGIC, TABLE_BYTEORDER, len(appids)))
+        fh.write(appids.tobytes())
+        fh.write(offsets.tobytes())
+        fh.write(names)
+
+def iter_app_list(chunks):
+    # Yields the entries of a GetAppList response without holding the whole document.
+    # Raises ValueError unless the list ends with its closing bracket, so a cut-off response can't look like removed apps.
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    started = False
+    for chunk in chunks:
+        buffer += text.decode(chunk)
+        if not started:
+            match = APP_LIST_START.search(buffer)
+            if match is None:
+                buffer = buffer[-64:]
+                continue
+            started = True
+            buffer = buffer[match.end():]
+        pos = 0
+        while True:
+            pos = APP_LIST_SEPARATOR.match(buffer, pos).end()
+            if buffer.startswith(']', pos):
+                return
+            try:
+                entry, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as ex:
+                if len(buffer) - pos > MAX_APP_ENTRY_SIZE:
+                    raise ValueError(f"Malformed app list: {ex}")
+                # Entry continues in the next chunk.
+                break
+            yield entry
+        buffer = buffer[pos:]
+    if not started:
+        raise ValueError("No app list found in response")
+    raise ValueError("App list ended before its closing bracket")
+
+def name_hash(name):
+    return int.from_bytes(hashlib.blake2b((name or '').encode('utf-8'), digest_size=8).digest(), 'little')
+
+def merge_names(old_entries, changes, removed):
+    pending = sorted(changes.items())
+    index = 0
+    for appid, name in old_entries:
+        while index < len(pending) and pending[index][0] < appid:
+            yield pending[index]
+            index += 1
+        if index < len(pending) and pending[index][0] == appid:
+            yield pending[index]
+            index += 1
+        elif appid not in removed:
+            yield (appid, name)
+    yield from pending[index:]
+
+class AppManifest:
+    # Sorted appids and a hash of each app's name, as of the last `steambot index`.
+    @classmethod
+    def load(Cls, path):
+        path = Path(path)
+        if not path.is_file():
+            return None
+        data = path.read_bytes()
+        (magic, byteorder, count) = TABLE_HEADER.unpack_from(data)
+        if magic != MANIFEST_MAGIC or byteorder != TABLE_BYTEORDER:
+            return None
+        start = TABLE_HEADER.size
+        appids = array('I', data[start:start + 4 * count])
+        hashes = array('Q', data[start + 4 * count:start + 12 * count])
+        return Cls(appids, hashes)
+    @classmethod
+    def from_entries(Cls, entries):
+        manifest = Cls()
+        for appid, name in sorted(entries):
+            manifest.appids.append(appid)
+            manifest.hashes.append(name_hash(name))
+        return manifest
+    def __init__(self, appids=None, hashes=None):
+        self.appids = appids if appids is not None else array('I')
+        self.hashes = hashes if hashes is not None else array('Q')
+    def __len__(self):
+        return len(self.appids)
+    def save(self, path):
+        with steambot.state.AtomicBinaryFile(path, prefix='manifest_') as fh:
+            fh.write(TABLE_HEADER.pack(MANIFEST_MAGIC, TABLE_BYTEORDER, len(self.appids)))
+            fh.write(self.appids.tobytes())
+            fh.write(self.hashes.tobytes())
+    def diff(self, entries):
+        # Returns ({appid: name} for inserted and renamed apps, {appid} for removed apps, {appid} for inserted apps).
+        seen = bytearray(len(self.appids))
+        changes = {}
+        inserted = set()
+        for entry in entries:
+            appid = entry['appid']
+            name = entry['name']
+            index = bisect_left(self.appids, appid)
+            if index < len(self.appids) and self.appids[index] == appid:
+                seen[index] = 1
+                if self.hashes[index] != name_hash(name):
+                    changes[appid] = name
+            else:
+                changes[appid] = name
+                inserted.add(appid)
+        removed = set([appid for appid, was_seen in zip(self.appids, seen) if not was_seen])
+        return (changes, removed, inserted)
+    def updated(self, changes, removed):
+        manifest = AppManifest()
+        for appid, name_or_hash in merge_names(zip(self.appids, self.hashes), changes, removed):
+            manifest.appids.append(appid)
+            manifest.hashes.append(name_or_hash if appid not in changes else name_hash(name_or_hash))
+        return manifest
+
+class NameTable:
+    @classmethod
+    def load(Cls, path):
+        with open(path, 'rb') as fh:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = Path(path).stat()
+        (magic, byteorder, count) = TABLE_HEADER.unpack_from(data)
+        if magic != NAME_TABLE_MAGIC or byteorder != TABLE_BYTEORDER:
+            data.close()
+            return None
+        return Cls(data, count, (stat.st_ino, stat.st_mtime_ns))
+    def __init__(self, data, count, version):
+        self.data = data
+        self.version = version
+        view = memoryview(data)
+        start = TABLE_HEADER.size
+        self.appids = view[start:start + 4 * count].cast('I')
+        start += 4 * count
+        self.offsets = view[start:start + 4 * (count + 1)].cast('I')
+        self.names = view[start + 4 * (count + 1):]
+    def __len__(self):
+        return len(self.appids)
+    def __iter__(self):
+        for index, appid in enumerate(self.appids):
+            yield (appid, self._name_at(index))
+    def _name_at(self, index):
+        return str(self.names[self.offsets[index]:self.offsets[index + 1]], 'utf-8')
+    def get(self, appid):
+        index = bisect_left(self.appids, appid)
+        if index == len(self.appids) or self.appids[index] != appid:
+            return None
+        return self._name_at(index)
+
+def reload_table(table_class, path, table):
+    # Returns the table at path, or the given one if the file hasn't been replaced since it was loaded.
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return table
+    if table is not None and table.version == (stat.st_ino, stat.st_mtime_ns):
+        return table
+    return table_class.load(path)
+
 class SteamApps:
     @classmethod
     def load(Cls, config, log):
+        if config['search_backend'] not in SEARCH_BACKENDS:
+            raise Exception(f"Unknown search_backend '{config['search_backend']}', must be 'trigram' or 'whoosh'!")
         index = create_steamapp_index(config)
         log.info(f"Indexes loaded - {index.doc_count()} entries")
-        return Cls(index)
-    def __init__(self, index):
+        search_path = Path(config['steam_search_file']) if config['search_backend'] == 'trigram' else None
+        return Cls(index, Path(config['steam_names_file']), log, search_path, config['search_threads'])
+    def __init__(self, index, names_path=None, log=None, search_path=None, threads=1):
         self.index = index
+        self.names_path = names_path
+        self.search_path = search_path
+        self.log = log
+        self.names = None
+        self.search = None
+        self.checked = None
+        self.lock = threading.Lock()
+        # The *_async methods run here, so lookups don't block the event loop; the threads start on first use.
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='steamapps')
+        # Thread ID -> (whoosh searcher, time.monotonic() it was last checked for a new generation).
+        self.searchers = {}
+        self._refresh()
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for searcher, _ in self.searchers.values():
+            searcher.close()
+        self.searchers.clear()
+    def _refresh(self):
+        # `steambot index` replaces the files while the bot runs; the old ones stay mapped until the new ones are in.
+        now = time.monotonic()
+        if self.checked is not None and now - self.checked < NAME_TABLE_CHECK_SECONDS:
+            return
+        with self.lock:
+            if self.checked is not None and now - self.checked < NAME_TABLE_CHECK_SECONDS:
+                return
+            self.checked = now
+            self._reload_tables()
+    def _reload_tables(self):
+        if self.names_path is not None:
+            names = reload_table(NameTable, self.names_path, self.names)
+            if names is not self.names and names is not None and self.log is not None:
+                self.log.info(f"Name table loaded - {len(names)} entries")
+            self.names = names
+        if self.search_path is not None:
+            search = reload_table(steambot.search.SearchIndex, self.search_path, self.search)
+            if search is not self.search and search is not None and self.log is not None:
+                self.log.info(f"Search index loaded - {len(search)} entries")
+            self.search = search
+    def _searcher(self):
+        # Whoosh searchers can't be shared between threads, so each thread keeps its own open between queries.
+        key = threading.get_ident()
+        now = time.monotonic()
+        entry = self.searchers.get(key)
+        if entry is None:
+            searcher = self.index.searcher()
+        elif now - entry[1] < NAME_TABLE_CHECK_SECONDS:
+            return entry[0]
+        else:
+            # The same searcher, unless `steambot index` committed a new generation since.
+            searcher = entry[0].refresh()
+        self.searchers[key] = (searcher, now)
+        return searcher
+    def current_names(self):
+        self._refresh()
+        return self.names
     def name_from_id(self, appid):
-        with self.index.searcher() as searcher:
-            results = list(searcher.documents(appid=appid))
-        if not results:
-            return None
-        return results[0]['name']
+        return self.names_from_ids([appid])[appid]
+    def names_from_ids(self, appids):
+        # {appid: name, or None if there's no such app}
+        self._refresh()
+        if self.names is not None:
+            return dict([(appid, self.names.get(int(appid))) for appid in appids])
+        searcher = self._searcher()
+        names = {}
+        for appid in appids:
+            document = searcher.document(appid=int(appid))
+            names[appid] = document['name'] if document is not None else None
+        return names
     def search_names(self, name):
+        self._refresh()
+        if self.search is not None:
+            return self.search.search(name)
+        # Until `steambot index` has written the search index, or with "search_backend": "whoosh".
         parser = whoosh.qparser.QueryParser('name', schema=self.index.schema, group=whoosh.qparser.AndGroup)
         query = parser.parse(name)
-        with self.index.searcher() as searcher:
-            results = []
-            for result in searcher.search(query):
-                r_appid = result['appid']
-                r_name = result['name']
-                results.append((r_appid, r_name))
-            return results
-
+        results = []
+        for result in self._searcher().search(query):
+            r_appid = result['appid']
+            r_name = result['name']
+            results.append((r_appid, r_name))
+        return results
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+    async def name_from_id_async(self, appid):
+        return await self._run(self.name_from_id, appid)
+    async def names_from_ids_async(self, appids):
+        # Copied, so the caller can change the list while the lookup runs.
+        return await self._run(self.names_from_ids, tuple(appids))
+    async def search_names_async(self, name):
+        return await self._run(self.search_names, name)
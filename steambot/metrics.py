@@ -0,0 +1,105 @@
+import asyncio
+import bisect
+import time
+
+# Seconds; the buckets for every histogram below.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+LOOP_LAG_INTERVAL = 1.0
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join([f'{name}="{value}"' for name, value in zip(names, values)])
+    return '{' + pairs + '}'
+
+class Metric:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = labels
+        self.values = {}
+        REGISTRY.append(self)
+    def header(self):
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.TYPE}"]
+
+class Counter(Metric):
+    TYPE = 'counter'
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+    def render(self):
+        return self.header() + [f"{self.name}{_labels(self.label_names, k)} {v}" for k, v in self.values.items()]
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+    def set(self, value, *labels):
+        self.values[labels] = value
+    def render(self):
+        return self.header() + [f"{self.name}{_labels(self.label_names, k)} {v}" for k, v in self.values.items()]
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+    def observe(self, value, *labels):
+        # [bucket counts..., sum]; counts are per bucket and summed up when rendered.
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(BUCKETS) + 1) + [0.0]
+        counts[bisect.bisect_left(BUCKETS, value)] += 1
+        counts[-1] += value
+    def render(self):
+        lines = self.header()
+        for k, counts in self.values.items():
+            total = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), counts):
+                total += count
+                lines.append(f"{self.name}_bucket{_labels(self.label_names + ('le',), k + (bound,))} {total}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, k)} {counts[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, k)} {total}")
+        return lines
+
+REGISTRY = []
+
+sweep_seconds = Histogram('steambot_sweep_seconds', "Time to check all due feeds once.")
+fetch_seconds = Histogram('steambot_fetch_seconds', "Time to download one feed.")
+fetch_status = Counter('steambot_fetch_status_total', "HTTP responses per feed and status code.", ('app_id', 'status'))
+fetch_errors = Counter('steambot_fetch_errors_total', "Feed downloads that timed out or failed without a response.")
+parse_seconds = Histogram('steambot_parse_seconds', "Time to parse one feed.")
+new_items = Counter('steambot_new_items_total', "New feed items found.")
+embeds_sent = Counter('steambot_embeds_sent_total', "Embeds posted to Discord.")
+send_seconds = Histogram('steambot_send_seconds', "Time to post one message to Discord.")
+save_seconds = Histogram('steambot_save_seconds', "Time to save the state.")
+servers = Gauge('steambot_servers', "Servers in the state.")
+subscriptions = Gauge('steambot_subscriptions', "Subscriptions of all servers in the state.")
+active_feeds = Gauge('steambot_active_feeds', "Feeds with at least one server posting them.")
+quarantined_feeds = Gauge('steambot_quarantined_feeds', "Feeds that failed too many times in a row.")
+breaker_trips = Counter('steambot_breaker_trips_total', "Times polling was paused because most feeds failed at once.")
+loop_lag_seconds = Gauge('steambot_loop_lag_seconds', "How late the event loop last woke up a sleeping task.")
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+async def measure_loop_lag():
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag_seconds.set(max(0.0, time.monotonic() - start - LOOP_LAG_INTERVAL))
+
+async def serve(config, log, port=None):
+    # Returns the runner to clean up on exit, or None if the endpoint is turned off.
+    if config['metrics_port'] is None:
+        return None
+    if port is None:
+        port = config['metrics_port']
+    import aiohttp.web
+    async def handle(request):
+        return aiohttp.web.Response(body=render().encode(), headers={'Content-Type': CONTENT_TYPE})
+    app = aiohttp.web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, config['metrics_host'], port).start()
+    log.info(f"Serving metrics at http://{config['metrics_host']}:{port}/metrics")
+    return runner
@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+import steambot.diagnostics
+import steambot.feeds
+import steambot.metrics
+import steambot.schedule
+import steambot.spool
+
+# How often the poller re-reads which feeds have subscribers.
+SUBSCRIPTIONS_REFRESH_SECONDS = 60
+SPOOL_PRUNE_SECONDS = 3600
+QUARANTINE_REPORT_SECONDS = 3600
+
+class FeedPoller:
+    # Polls the feeds of one partition of app IDs and spools new items for the bot.
+    def __init__(self, program_state, config, log, partition=(0, 1)):
+        self.program_state = program_state
+        self.config = config
+        self.log = log
+        self.partition = partition
+        self.fetcher = steambot.feeds.FeedFetcher(config, log)
+        self.scheduler = steambot.schedule.FeedScheduler(config)
+        self.spool = steambot.spool.Spool(config['spool_database'])
+        self.subscribers = {}
+    def refresh_subscriptions(self):
+        (index, count) = self.partition
+        feeds = self.program_state.store.active_feeds()
+        self.subscribers = dict([(k, v) for k, v in feeds.items() if k % count == index])
+        self.log.debug(f"Polling {len(self.subscribers)} of {len(feeds)} feeds")
+    async def poll(self):
+        new_items = await self.program_state.poll_feeds(self.fetcher, self.subscribers, self.subscribers.get, self.log, self.scheduler)
+        if new_items:
+            self.spool.put(new_items)
+            # Only now, so that the items are fetched again if they couldn't be spooled.
+            self.program_state.advance_feeds(new_items)
+            self.log.info(f"Spooled {sum([len(items) for app_id, items in new_items])} new items from {len(new_items)} feeds.")
+    async def run(self):
+        refreshed = None
+        pruned = time.monotonic()
+        reported = time.monotonic()
+        watchdog = None
+        if self.config['stall_threshold_seconds'] is not None:
+            watchdog = steambot.diagnostics.LoopWatchdog(self.config['stall_threshold_seconds'], self.log)
+            watchdog.start()
+        metrics_runner = None
+        loop_lag_task = None
+        if self.config['metrics_port'] is not None:
+            # The bot serves on metrics_port, so every partition gets the next one after it.
+            metrics_runner = await steambot.metrics.serve(self.config, self.log, self.config['metrics_port'] + 1 + self.partition[0])
+            loop_lag_task = asyncio.create_task(steambot.metrics.measure_loop_lag())
+        try:
+            while True:
+                now = time.monotonic()
+                if refreshed is None or now - refreshed > SUBSCRIPTIONS_REFRESH_SECONDS:
+                    self.refresh_subscriptions()
+                    refreshed = now
+                if now - pruned > SPOOL_PRUNE_SECONDS:
+                    self.log.debug(f"Pruned {self.spool.prune()} spooled items")
+                    pruned = now
+                if now - reported > QUARANTINE_REPORT_SECONDS:
+                    self.program_state.report_quarantine(self.config, self.log, app_ids=self.subscribers)
+                    reported = now
+                try:
+                    await self.poll()
+                except Exception as ex:
+                    self.log.warning(f"Error polling feeds: {ex}")
+                await asyncio.sleep(self.config['scheduler_tick_seconds'])
+        finally:
+            if watchdog is not None:
+                watchdog.stop()
+            if loop_lag_task is not None:
+                loop_lag_task.cancel()
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+            await self.fetcher.close()
+            self.spool.close()
@@ -0,0 +1,129 @@
+import heapq
+import math
+import random
+import statistics
+import time
+
+import steambot.feeds
+
+# Fraction of an interval that is randomized, so feeds don't line up.
+JITTER = 0.1
+# How much the interval grows each time a feed turns out to be unchanged.
+BACKOFF = 1.5
+# Poll this many times per expected post.
+POLLS_PER_POST = 4
+# Number of recent post dates remembered per feed.
+HISTORY_LENGTH = 10
+# The circuit breaker only judges sweeps with at least this many fetches.
+BREAKER_MIN_FETCHES = 10
+
+class CircuitBreaker:
+    # Pauses all polling when most feeds fail at once, because then Steam is down rather than the feeds.
+    def __init__(self, config, clock=time.monotonic):
+        self.failure_ratio = config['breaker_failure_ratio']
+        self.pause = config['breaker_pause_seconds']
+        self.max_pause = config['max_breaker_pause_seconds']
+        self.clock = clock
+        self.trips = 0
+        self.open_until = None
+    def is_open(self):
+        return self.open_until is not None and self.clock() < self.open_until
+    def record(self, fetches, failures):
+        # Returns whether the sweep tripped the breaker; the pause doubles while it keeps tripping.
+        if fetches < BREAKER_MIN_FETCHES:
+            return False
+        if failures < fetches * self.failure_ratio:
+            self.trips = 0
+            return False
+        self.trips += 1
+        self.open_until = self.clock() + min(self.pause * 2 ** (self.trips - 1), self.max_pause)
+        return True
+
+class FeedScheduler:
+    def __init__(self, config, clock=time.monotonic):
+        self.default_interval = config['seconds_between_updates']
+        self.min_interval = config['min_seconds_between_updates']
+        self.max_interval = config['max_seconds_between_updates']
+        self.failure_backoff = config['feed_failure_backoff_seconds']
+        self.max_failure_backoff = config['max_feed_failure_backoff_seconds']
+        self.clock = clock
+        self.breaker = CircuitBreaker(config, clock)
+        self.queue = []
+        self.due = {}
+        self.intervals = {}
+        self.history = {}
+    def __len__(self):
+        return len(self.due)
+    def _push(self, app_id, when):
+        self.due[app_id] = when
+        heapq.heappush(self.queue, (when, app_id))
+    def _jittered(self, interval):
+        return interval * random.uniform(1 - JITTER, 1 + JITTER)
+    def backoff(self, failures):
+        return min(self.failure_backoff * 2 ** (failures - 1), self.max_failure_backoff)
+    def sync(self, app_ids, seen=(), failures=None):
+        # failures is {app_id: (count, time.time() of the last failure)}, so backoffs survive restarts.
+        now = self.clock()
+        for app_id in app_ids:
+            if app_id in self.due:
+                continue
+            if failures is not None and app_id in failures:
+                (count, failed_at) = failures[app_id]
+                self._push(app_id, now + max(0, failed_at + self.backoff(count) - time.time()))
+            elif app_id not in seen:
+                # Never polled before, so someone just added it.
+                self._push(app_id, now)
+            else:
+                # Spread new feeds over one interval instead of polling them all at once.
+                self._push(app_id, now + random.uniform(0, self.default_interval))
+    def pop_due(self, app_ids):
+        now = self.clock()
+        result = []
+        if self.breaker.is_open():
+            return result
+        while self.queue and self.queue[0][0] <= now:
+            when, app_id = heapq.heappop(self.queue)
+            if self.due.get(app_id) != when:
+                # Superseded by a later push.
+                continue
+            del self.due[app_id]
+            if app_id in app_ids:
+                result.append(app_id)
+            else:
+                self.intervals.pop(app_id, None)
+                self.history.pop(app_id, None)
+        return result
+    def observe(self, app_id, items, last_seen):
+        # Feeds are parsed only down to the last seen item, so remember what was seen before.
+        dates = set(self.history.get(app_id, []))
+        if last_seen is not None:
+            dates.add(last_seen)
+        dates.update([x.timestamp() for x in items if x.date is not None])
+        dates = sorted(dates, reverse=True)[:HISTORY_LENGTH]
+        self.history[app_id] = dates
+        return dates
+    def estimate_interval(self, dates, subscribers):
+        if len(dates) < 2:
+            return self.default_interval
+        gaps = [a - b for a, b in zip(dates, dates[1:])]
+        # A feed that has been quiet for longer than it usually is between posts has slowed down.
+        gap = max(statistics.median(gaps), time.time() - dates[0])
+        # Popular feeds are checked more often.
+        return gap / POLLS_PER_POST / (1 + math.log10(max(subscribers, 1)))
+    def reschedule(self, app_id, items, subscribers, last_seen=None, failures=0):
+        interval = self.intervals.get(app_id, self.default_interval)
+        if items is None and failures:
+            # Keep the interval as it was for when the feed comes back.
+            self._push(app_id, self.clock() + self._jittered(self.backoff(failures)))
+            return
+        if items is None and self.breaker.is_open():
+            # Not the feed's fault; spread the feeds out again after the pause.
+            self._push(app_id, self.breaker.open_until + random.uniform(0, interval))
+            return
+        if items is steambot.feeds.NOT_MODIFIED:
+            interval *= BACKOFF
+        elif items is not None:
+            interval = self.estimate_interval(self.observe(app_id, items, last_seen), subscribers)
+        interval = min(max(interval, self.min_interval), self.max_interval)
+        self.intervals[app_id] = interval
+        self._push(app_id, self.clock() + self._jittered(interval))
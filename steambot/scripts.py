@@ -1,13 +1,21 @@
 from pathlib import Path
 import argparse
-import requests
 
+# The other modules are imported by the actions that need them, so e.g. `steambot index` doesn't load discord.
 import steambot.config
 import steambot.logconfig
-import steambot.index
-import steambot.feeds
-import steambot.bot
-import steambot.state
+
+def parse_shards(text):
+    (first, last) = [int(x) for x in text.split('-')]
+    if not 0 <= first <= last:
+        raise ValueError(f"Shards must be a range like 0-3, not '{text}'")
+    return list(range(first, last + 1))
+
+def parse_partition(text):
+    (index, count) = [int(x) for x in text.split('/')]
+    if not 0 <= index < count:
+        raise ValueError(f"Partition must be K/N with 0 <= K < N, not '{text}'")
+    return (index, count)
 
 def configure(config_path, log_config_path):
     log = steambot.logconfig.init_logging(log_config_path)
@@ -16,56 +24,194 @@ def configure(config_path, log_config_path):
     config = steambot.config.load_configuration(config_path, log)
     return config, log
 
-def run_bot(config_path, log_config_path):
+def check_feed_mode(config, log):
+    if config['feed_mode'] not in ('inline', 'poller'):
+        log.critical(f"Unknown feed_mode '{config['feed_mode']}', must be 'inline' or 'poller'!")
+        return False
+    if config['feed_mode'] == 'poller' and config['state_backend'] != 'sqlite':
+        log.critical("The poller needs \"state_backend\": \"sqlite\" to share state with the bot!")
+        return False
+    return True
+
+def run_bot(config_path, log_config_path, shard_ids=None, shard_count=None):
+    import steambot.bot
+    import steambot.index
+    import steambot.state
     config, log = configure(config_path, log_config_path)
     if config['bot_token'] == steambot.config.TOKEN_PLACEHOLDER:
         log.critical(f"Replace {steambot.config.TOKEN_PLACEHOLDER} in your config!")
         return 1
-    log.info("Getting Steam apps...")
-    steam_app_list = steambot.index.SteamApps.load(config, log)
+    if not check_feed_mode(config, log):
+        return 1
+    shards = None
+    if shard_ids is not None:
+        if shard_count is None or shard_ids[-1] >= shard_count:
+            log.critical("--shards needs a --shard-count larger than the last shard!")
+            return 1
+        if config['feed_mode'] != 'poller':
+            log.critical("Running only some shards needs \"feed_mode\": \"poller\", so that every feed is still fetched once!")
+            return 1
+        shards = (shard_ids, shard_count)
+    def load():
+        log.info("Getting Steam apps...")
+        steam_app_list = steambot.index.SteamApps.load(config, log)
+        log.info("Getting state...")
+        return (steambot.state.ProgramState.load(config, log, shards), steam_app_list)
+    bot = steambot.bot.create_bot(load, config, log, shard_ids, shard_count)
+    # Connects while the state and Steam apps are still loading; the bot saves the state when it stops.
+    log.info("Running bot...")
+    bot.run(config['bot_token'])
+    log.info("Shutdown complete.")
+    return 0
+
+def run_poller(config_path, log_config_path, partition):
+    import asyncio
+    import steambot.poller
+    import steambot.state
+    config, log = configure(config_path, log_config_path)
+    if config['feed_mode'] != 'poller':
+        log.critical("Set \"feed_mode\": \"poller\" in your config, or the bot will poll the feeds too!")
+        return 1
+    if not check_feed_mode(config, log):
+        return 1
     log.info("Getting state...")
     program_state = steambot.state.ProgramState.load(config, log)
-    try:    
-        bot = steambot.bot.create_bot(program_state, steam_app_list, config, log)
-        log.info("Running bot...")
-        bot.run(config['bot_token'])
+    poller = steambot.poller.FeedPoller(program_state, config, log, partition)
+    log.info(f"Polling partition {partition[0]}/{partition[1]}. Press Ctrl+C to exit.")
+    try:
+        asyncio.run(poller.run())
+    except KeyboardInterrupt:
+        pass
     finally:
-        log.info("Saving state before exit...")
-        program_state.save(config, log)
+        program_state.store.close()
     log.info("Shutdown complete.")
     return 0
 
+def report_quarantine(config_path, log_config_path):
+    import steambot.index
+    import steambot.state
+    config, log = configure(config_path, log_config_path)
+    steam_app_list = steambot.index.SteamApps.load(config, log)
+    program_state = steambot.state.ProgramState.load(config, log)
+    try:
+        if not program_state.quarantined(config['quarantine_failures']):
+            log.info("No feeds are failing.")
+        program_state.report_quarantine(config, log, steam_app_list)
+    finally:
+        program_state.store.close()
+    return 0
+
+def manage_spool(config_path, log_config_path, drop):
+    import steambot.spool
+    config, log = configure(config_path, log_config_path)
+    spool = steambot.spool.Spool(config['spool_database'])
+    try:
+        for consumer in drop or []:
+            if spool.drop(consumer):
+                log.info(f"Dropped spool consumer {consumer}.")
+            else:
+                log.warning(f"There is no spool consumer {consumer}!")
+        for name, position, unread in spool.consumers():
+            log.info(f"Spool consumer {name}: at item {position}, {unread} unread.")
+    finally:
+        spool.close()
+    return 0
+
 def update_index(config_path, log_config_path):
+    import requests
+    import steambot.index
+    import steambot.search
     config, log = configure(config_path, log_config_path)
-    index = steambot.index.create_steamapp_index(config)
+    if config['search_backend'] not in steambot.index.SEARCH_BACKENDS:
+        log.critical(f"Unknown search_backend '{config['search_backend']}', must be 'trigram' or 'whoosh'!")
+        return 1
+    # The whoosh index is only kept up to date for the whoosh search backend.
+    use_whoosh = config['search_backend'] == 'whoosh'
+    index = steambot.index.create_steamapp_index(config) if use_whoosh else None
+    names_path = Path(config['steam_names_file'])
+    search_path = Path(config['steam_search_file'])
+    old_names = steambot.index.NameTable.load(names_path) if names_path.is_file() else None
+    manifest = steambot.index.AppManifest.load(config['steam_manifest_file'])
+    if manifest is None and use_whoosh:
+        log.info("No manifest found, creating one from the indexes...")
+        with index.searcher() as searcher:
+            manifest = steambot.index.AppManifest.from_entries([(d['appid'], d['name']) for d in searcher.documents()])
+    elif not use_whoosh and (manifest is None or old_names is None or len(old_names) != len(manifest)):
+        log.info("No name table to update, getting all apps...")
+        manifest = steambot.index.AppManifest()
+        old_names = None
     log.info("Getting app list...")
-    r = requests.get(config['steam_app_list_url'])
-    r.raise_for_status()
-    log.info("Updating indexes... (may take a while!)")
-    existing_appids = set([d['appid'] for d in index.searcher().documents()])
-    writer = index.writer(limitmb=256, procs=4)
-    new_count = 0
-    for entry in r.json()["applist"]["apps"]:
-        if entry['appid'] not in existing_appids:
-            new_count += 1
-            writer.update_document(appid=entry['appid'], name=entry['name'])
-    writer.commit()
-    log.info(f"Indexes updated - {new_count} new entries, {index.doc_count()} total")
+    with requests.get(config['steam_app_list_url'], stream=True) as r:
+        r.raise_for_status()
+        apps = steambot.index.iter_app_list(r.iter_content(chunk_size=65536))
+        try:
+            (changes, removed, inserted) = manifest.diff(apps)
+        except ValueError as ex:
+            log.critical(f"Not updating the indexes: {ex}")
+            return 1
+    log.info(f"{len(inserted)} new, {len(changes) - len(inserted)} renamed and {len(removed)} removed apps")
+    if len(removed) > config['max_removed_app_share'] * len(manifest):
+        # Steam doesn't drop that many apps at once; more likely the list is broken.
+        log.critical(f"Not updating the indexes: {len(removed)} of {len(manifest)} apps would be removed "
+            f"(more than \"max_removed_app_share\": {config['max_removed_app_share']})")
+        return 1
+    if not changes and not removed and (use_whoosh or steambot.search.has_search_index(search_path)):
+        log.info(f"Indexes are up to date - {len(manifest)} total")
+        return 0
+    if use_whoosh:
+        log.info("Updating indexes...")
+        # Spawning writer processes only pays off for a full rebuild.
+        procs = 4 if len(changes) > 10000 else 1
+        writer = index.writer(limitmb=256, procs=procs)
+        for appid, name in changes.items():
+            writer.update_document(appid=appid, name=name)
+        for appid in removed:
+            writer.delete_by_term('appid', appid)
+        writer.commit()
+        log.info(f"Indexes updated - {index.doc_count()} total")
+    log.info("Writing name table...")
+    if old_names is not None and len(old_names) == len(manifest):
+        steambot.index.write_name_table(names_path, steambot.index.merge_names(old_names, changes, removed))
+    elif use_whoosh:
+        with index.searcher() as searcher:
+            steambot.index.write_name_table(names_path, sorted([(d['appid'], d['name']) for d in searcher.documents()]))
+    else:
+        steambot.index.write_name_table(names_path, sorted(changes.items()))
+    if not use_whoosh:
+        log.info("Writing search index...")
+        # Written next to the old one and renamed over it, so a running bot switches over in one go.
+        steambot.search.write_search_index(search_path, steambot.index.NameTable.load(names_path))
+    # The manifest goes last, so an interrupted update is redone next time.
+    manifest = manifest.updated(changes, removed)
+    manifest.save(config['steam_manifest_file'])
+    if not use_whoosh:
+        log.info(f"Indexes updated - {len(manifest)} total")
     return 0
 
 def main():
     parser = argparse.ArgumentParser(
         prog='steambot',
         description='A Discord bot for Steam news feeds.')
-    parser.add_argument('action', choices=['bot', 'index'], help='bot: Run the bot; index: Update the Steam app index.')
+    parser.add_argument('action', choices=['bot', 'index', 'poller', 'quarantine', 'spool'],
+        help='bot: Run the bot; index: Update the Steam app index; poller: Poll feeds for the bot; quarantine: List the feeds that keep failing; spool: List the bots reading the spool.')
     parser.add_argument('-c', '--config', help='The path to an application settings file.', default='appsettings.json')
     parser.add_argument('-l', '--logconfig', help='The path to a log configuration file.', default='logging.conf')
+    parser.add_argument('-s', '--shards', help='bot only: Run these shards (e.g. 0-3) in this process. Needs --shard-count.', metavar='A-B', type=parse_shards)
+    parser.add_argument('-n', '--shard-count', help='bot only: The total number of shards. Without --shards, runs them all in this process.', type=int)
+    parser.add_argument('-p', '--partition', help='poller only: Poll the app IDs where ID %% N == K.', metavar='K/N', type=parse_partition, default=(0, 1))
+    parser.add_argument('-d', '--drop', help='spool only: Forget this consumer, e.g. bot-0-3 after the shards were split differently. Can be given more than once.', metavar='NAME', action='append')
     args = parser.parse_args()
     config_path = Path(args.config)
     log_config_path = Path(args.logconfig)
     if args.action == 'bot':
-        return steambot.scripts.run_bot(config_path, log_config_path)
+        return steambot.scripts.run_bot(config_path, log_config_path, args.shards, args.shard_count)
     elif args.action == 'index':
         return steambot.scripts.update_index(config_path, log_config_path)
+    elif args.action == 'poller':
+        return steambot.scripts.run_poller(config_path, log_config_path, args.partition)
+    elif args.action == 'quarantine':
+        return steambot.scripts.report_quarantine(config_path, log_config_path)
+    elif args.action == 'spool':
+        return steambot.scripts.manage_spool(config_path, log_config_path, args.drop)
     else:
-        raise Exception("First argument must be 'bot' or 'index'!")
+        raise Exception("First argument must be 'bot', 'index', 'poller', 'quarantine' or 'spool'!")
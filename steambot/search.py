@@ -0,0 +1,328 @@
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from pathlib import Path
+import heapq
+import mmap
+import struct
+import sys
+
+import steambot.state
+from steambot.complete import normalize
+
+SEARCH_MAGIC = b'SBSRCH02'
+SEARCH_HEADER = struct.Struct('<8s2sxxIIxxxx')
+SEARCH_BYTEORDER = b'le' if sys.byteorder == 'little' else b'be'
+# Whoosh's default, and what /steambot add shows as buttons at most.
+DEFAULT_LIMIT = 10
+# Candidates with the most trigrams in common with the query that are checked word by word.
+VERIFY_LIMIT = 200
+
+# Ranked best first, for each word of the query.
+WORD_EXACT, WORD_PREFIX, WORD_TYPO = (3, 2, 1)
+
+def trigram(text):
+    return (ord(text[0]) << 42) | (ord(text[1]) << 21) | ord(text[2])
+
+def name_trigrams(words):
+    trigrams = set()
+    for word in words:
+        padded = f' {word} '
+        trigrams.update([trigram(padded[i:i + 3]) for i in range(len(padded) - 2)])
+    return trigrams
+
+def query_trigrams(word):
+    # No padding at the end, so a word that is still being typed matches as a prefix.
+    padded = f' {word}'
+    return [trigram(padded[i:i + 3]) for i in range(len(padded) - 2)]
+
+def allowed_typos(word):
+    if len(word) < 4:
+        return 0
+    return 1 if len(word) < 8 else 2
+
+def spoilable(word):
+    # Whether the allowed typos can spoil every trigram of the word, see SearchIndex._seed.
+    return len(set(query_trigrams(word))) <= 4 * allowed_typos(word)
+
+def needs_walk(word):
+    return allowed_typos(word) == 1 and spoilable(word)
+
+def within_distance(query_word, word, limit):
+    # Whether query_word is at most limit typos away from word, or from the start of it.
+    # A typo is a wrong, missing or extra letter, or two letters swapped.
+    word = word[:len(query_word) + limit]
+    if len(word) < len(query_word) - limit:
+        return False
+    before = None
+    previous = list(range(len(word) + 1))
+    for i, char in enumerate(query_word, 1):
+        current = [i]
+        for j, other in enumerate(word, 1):
+            distance = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != other))
+            if i > 1 and j > 1 and char == word[j - 2] and other == query_word[i - 2]:
+                distance = min(distance, before[j - 2] + 1)
+            current.append(distance)
+        if min(current) > limit and min(previous) >= limit:
+            # Giving up as soon as it can't be; a swap can still come from the row before.
+            return False
+        (before, previous) = (previous, current)
+    return min(previous) <= limit
+
+def next_distances(word, before, previous, previous_letter, letter):
+    # One more row of within_distance, for a text that goes on with letter.
+    current = [previous[0] + 1]
+    for i, char in enumerate(word, 1):
+        distance = min(previous[i] + 1, current[i - 1] + 1, previous[i - 1] + (char != letter))
+        if before is not None and i > 1 and char == previous_letter and letter == word[i - 2]:
+            distance = min(distance, before[i - 2] + 1)
+        current.append(distance)
+    return current
+
+def match_score(query_words, words, typos=True):
+    # Every word of the query has to match a word of the name, like whoosh's AND queries.
+    score = 0
+    for query_word in query_words:
+        best = 0
+        for word in words:
+            if word == query_word:
+                best = WORD_EXACT
+                break
+            if word.startswith(query_word):
+                best = WORD_PREFIX
+        if not best and typos:
+            # Only worth the edit distances when no word matches without typos.
+            # Each letter that is not in a word at all takes a typo of its own, which rules out most words quickly.
+            limit = allowed_typos(query_word)
+            letters = set(query_word)
+            if limit and any([within_distance(query_word, word, limit)
+                              for word in words if len(letters.difference(word)) <= limit]):
+                best = WORD_TYPO
+        if not best:
+            return None
+        score += best
+    return score
+
+def write_search_index(path, entries):
+    # Layout: header, sorted uint64 trigrams, uint32 posting offsets (one extra for the end), uint32 postings,
+    # uint32 appids, uint32 name offsets (one extra for the end), uint32 word offsets (one extra for the end),
+    # UTF-8 names, UTF-8 normalized names, so searches don't have to normalize the names they check.
+    # Documents are numbered shortest name first, so among equal matches the shortest names come first.
+    documents = sorted([(len(normalize(name or '')), appid, name or '') for appid, name in entries])
+    postings = {}
+    appids = array('I')
+    name_offsets = array('I', [0])
+    word_offsets = array('I', [0])
+    names = bytearray()
+    words = bytearray()
+    for document, (length, appid, name) in enumerate(documents):
+        appids.append(appid)
+        names += name.encode('utf-8')
+        name_offsets.append(len(names))
+        normalized = normalize(name)
+        words += normalized.encode('utf-8')
+        word_offsets.append(len(words))
+        for key in name_trigrams(normalized.split()):
+            postings.setdefault(key, array('I')).append(document)
+    keys = array('Q', sorted(postings))
+    offsets = array('I', [0])
+    for key in keys:
+        offsets.append(offsets[-1] + len(postings[key]))
+    with steambot.state.AtomicBinaryFile(path, prefix='search_') as fh:
+        fh.write(SEARCH_HEADER.pack(SEARCH_MAGIC, SEARCH_BYTEORDER, len(appids), len(keys)))
+        fh.write(keys.tobytes())
+        fh.write(offsets.tobytes())
+        for key in keys:
+            fh.write(postings[key].tobytes())
+        fh.write(appids.tobytes())
+        fh.write(name_offsets.tobytes())
+        fh.write(word_offsets.tobytes())
+        fh.write(names)
+        fh.write(words)
+
+def has_search_index(path):
+    # Whether path holds a search index this version can read, so `steambot index` rewrites older ones.
+    try:
+        with open(path, 'rb') as fh:
+            header = fh.read(SEARCH_HEADER.size)
+    except FileNotFoundError:
+        return False
+    return len(header) == SEARCH_HEADER.size and SEARCH_HEADER.unpack(header)[:2] == (SEARCH_MAGIC, SEARCH_BYTEORDER)
+
+class SearchIndex:
+    # A trigram index of the app names, memory-mapped from the file `steambot index` writes.
+    @classmethod
+    def load(Cls, path):
+        with open(path, 'rb') as fh:
+            data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            stat = Path(path).stat()
+        (magic, byteorder, count, key_count) = SEARCH_HEADER.unpack_from(data)
+        if magic != SEARCH_MAGIC or byteorder != SEARCH_BYTEORDER:
+            data.close()
+            return None
+        return Cls(data, count, key_count, (stat.st_ino, stat.st_mtime_ns))
+    def __init__(self, data, count, key_count, version):
+        self.data = data
+        self.version = version
+        view = memoryview(data)
+        start = SEARCH_HEADER.size
+        self.keys = view[start:start + 8 * key_count].cast('Q')
+        start += 8 * key_count
+        self.offsets = view[start:start + 4 * (key_count + 1)].cast('I')
+        start += 4 * (key_count + 1)
+        posting_count = self.offsets[-1] if key_count else 0
+        self.postings = view[start:start + 4 * posting_count].cast('I')
+        start += 4 * posting_count
+        self.appids = view[start:start + 4 * count].cast('I')
+        start += 4 * count
+        self.name_offsets = view[start:start + 4 * (count + 1)].cast('I')
+        start += 4 * (count + 1)
+        self.word_offsets = view[start:start + 4 * (count + 1)].cast('I')
+        start += 4 * (count + 1)
+        self.names = view[start:start + self.name_offsets[-1]]
+        self.words = view[start + self.name_offsets[-1]:]
+        low = ord(' ') << 42
+        self.first_letters = set([chr((self.keys[index] >> 21) & 0x1FFFFF)
+                                  for index in range(bisect_left(self.keys, low), bisect_left(self.keys, low + (1 << 42)))])
+    def __len__(self):
+        return len(self.appids)
+    def _name_at(self, document):
+        return str(self.names[self.name_offsets[document]:self.name_offsets[document + 1]], 'utf-8')
+    def _words_at(self, document):
+        return str(self.words[self.word_offsets[document]:self.word_offsets[document + 1]], 'utf-8').split()
+    def _postings(self, key):
+        index = bisect_left(self.keys, key)
+        if index == len(self.keys) or self.keys[index] != key:
+            return ()
+        return self.postings[self.offsets[index]:self.offsets[index + 1]]
+    def _following(self, first, second):
+        # The trigrams that start with these two letters, which are next to each other in the file.
+        low = (ord(first) << 42) | (ord(second) << 21)
+        start = bisect_left(self.keys, low)
+        end = bisect_left(self.keys, low + (1 << 21), start)
+        return [(chr(self.keys[index] & 0x1FFFFF), index) for index in range(start, end)]
+    def _typo_postings(self, word, typos):
+        # The names with a word that starts at most typos away from this one. The words of the index are spelled out
+        # a letter at a time by following their trigrams, and dropped as soon as they are too far off.
+        found = set()
+        following = {}
+        start = list(range(len(word) + 1))
+        stack = [(' ', letter, start, next_distances(word, None, start, ' ', letter), []) for letter in self.first_letters]
+        while stack:
+            (previous_letter, letter, before, distances, indices) = stack.pop()
+            if distances[-1] <= typos:
+                postings = sorted([self.postings[self.offsets[index]:self.offsets[index + 1]] for index in indices], key=len)
+                documents = set(postings[0])
+                for other in postings[1:]:
+                    documents.intersection_update(other)
+                found.update(documents)
+                continue
+            if (previous_letter, letter) not in following:
+                following[(previous_letter, letter)] = self._following(previous_letter, letter)
+            for next_letter, index in following[(previous_letter, letter)]:
+                if next_letter == ' ':
+                    continue
+                after = next_distances(word, before, distances, letter, next_letter)
+                if min(after) <= typos or min(distances) < typos:
+                    stack.append((letter, next_letter, distances, after, indices + [index]))
+        return found
+    def _seed(self, word):
+        # Every name that matches the word, even with the allowed typos, is in one of these postings,
+        # because each typo spoils at most four of its trigrams (a swap does). One typo can spoil all of a short word's,
+        # so search looks those up letter by letter. Two typos only spoil all of them if one is a swap, and looking
+        # those up letter by letter takes far too long, so they are missed.
+        trigrams = set(query_trigrams(word))
+        typos = allowed_typos(word)
+        postings = sorted([self._postings(key) for key in trigrams], key=len)
+        if len(trigrams) > 4 * typos:
+            return postings[:4 * typos + 1]
+        return postings
+    def search(self, query, limit=DEFAULT_LIMIT):
+        # Returns [(appid, name)], best match first.
+        # Like whoosh, names with typos are only looked for when no name matches without them.
+        query_words = normalize(query).split()
+        # A name that matches a word without typos has all of its trigrams, which narrows it down a lot.
+        containing = [self._containing(word) for word in query_words]
+        results = []
+        found = [documents for documents in containing if documents is not None]
+        if found and all(found):
+            found = set.intersection(*found)
+            if found:
+                results = self._verify(query_words, dict.fromkeys(found, 0), limit, set(), False)
+        if not results:
+            results = self._search_typos(query_words, limit, containing)
+        return [(self.appids[document], self._name_at(document)) for _, _, document in results[:limit]]
+    def _containing(self, word):
+        # The names with all trigrams of the word, or None if it has none.
+        found = None
+        for postings in sorted([self._postings(key) for key in set(query_trigrams(word))], key=len):
+            if found is None:
+                found = set(postings)
+            else:
+                found.intersection_update(postings)
+            if not found:
+                break
+        return found
+    def _has_word(self, word, documents):
+        # Whether some of these names have a word that starts with this one, not just its trigrams spread over several.
+        for _, document in zip(range(VERIFY_LIMIT), documents):
+            if any([other.startswith(word) for other in self._words_at(document)]):
+                return True
+        return False
+    def _search_typos(self, query_words, limit, containing):
+        counts = Counter()
+        # A word that some name has as it is typed is taken to be spelled right, so the names have to have it too.
+        # Otherwise they have some of the seeds of the word, unless typos can spoil all of its trigrams.
+        allowed = None
+        short_words = []
+        for word, documents in zip(query_words, containing):
+            if len(word) <= 1:
+                continue
+            if documents and self._has_word(word, documents):
+                found = documents
+            else:
+                # Only these tell the candidates apart, all of them have the other words.
+                seeds = self._seed(word)
+                for postings in seeds:
+                    counts.update(postings)
+                if needs_walk(word):
+                    short_words.append(word)
+                    continue
+                if spoilable(word):
+                    continue
+                found = set().union(*seeds)
+            allowed = found if allowed is None else allowed.intersection(found)
+        if allowed is not None:
+            counts = dict([(document, counts[document]) for document in allowed])
+        verified = set()
+        results = self._verify(query_words, counts, limit, verified)
+        if short_words:
+            typo_counts = Counter()
+            for word in short_words:
+                typo_counts.update(self._typo_postings(word, 1))
+            typo_counts = dict([(document, count) for document, count in typo_counts.items()
+                                if document not in verified and (allowed is None or document in allowed)])
+            results += self._verify(query_words, typo_counts, limit, verified)
+        # Sharing more trigrams says little about how close a name with typos is, so the shortest come first.
+        return sorted([(score, 0, document) for score, _, document in results])
+    def _verify(self, query_words, counts, limit, verified, typos=True):
+        if not counts:
+            return []
+        # The best candidates by trigram count, and the shortest names among equal counts.
+        cutoff = heapq.nlargest(VERIFY_LIMIT, counts.values())[-1]
+        candidates = sorted([(-count, document) for document, count in counts.items() if count >= cutoff])
+        results = []
+        best_score = WORD_EXACT * len(query_words)
+        best_count = 0
+        for _, document in candidates[:VERIFY_LIMIT]:
+            verified.add(document)
+            score = match_score(query_words, self._words_at(document), typos)
+            if score is not None:
+                results.append((-score, -counts[document], document))
+                if score == best_score:
+                    best_count += 1
+                    # The candidates come by count and then document, so none of the rest can rank higher.
+                    if best_count == limit:
+                        break
+        results.sort()
+        return results
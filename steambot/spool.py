@@ -0,0 +1,101 @@
+from pathlib import Path
+import collections
+import json
+import sqlite3
+import time
+
+import steambot.feeds
+
+# Items older than this are dropped even if a consumer never read them.
+SPOOL_RETENTION_SECONDS = 86400
+
+class Spool:
+    # New feed items handed from the poller processes to the bot processes.
+    # Every consumer keeps its own position, so several bots can read the same items.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, app_id INTEGER NOT NULL, item TEXT NOT NULL, created REAL NOT NULL);
+        CREATE TABLE IF NOT EXISTS consumers (name TEXT PRIMARY KEY, position INTEGER NOT NULL);
+    """
+    def __init__(self, path):
+        self.path = Path(path).absolute()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA busy_timeout=5000")
+        self.connection.executescript(self.SCHEMA)
+    def close(self):
+        self.connection.close()
+    def put(self, new_items):
+        now = time.time()
+        with self.connection:
+            self.connection.executemany("INSERT INTO items (app_id, item, created) VALUES (?, ?, ?)",
+                [(app_id, json.dumps(item.serialize()), now) for app_id, items in new_items for item in items])
+    def position(self, consumer):
+        row = self.connection.execute("SELECT position FROM consumers WHERE name = ?", (consumer,)).fetchone()
+        if row is not None:
+            return row[0]
+        # A new consumer, e.g. after the shards were split differently, starts where the others are instead of
+        # posting everything in the spool again, and after the newest item if there are no others.
+        with self.connection:
+            (position,) = self.connection.execute("SELECT COALESCE((SELECT MIN(position) FROM consumers), "
+                "(SELECT MAX(id) FROM items), 0)").fetchone()
+            self.connection.execute("INSERT INTO consumers VALUES (?, ?)", (consumer, position))
+        return position
+    def consumers(self):
+        # Returns [(name, position, unread items)].
+        return self.connection.execute("SELECT name, position, (SELECT COUNT(*) FROM items WHERE id > position) "
+            "FROM consumers ORDER BY name").fetchall()
+    def drop(self, consumer):
+        # Forgets a consumer that is no longer used, so it doesn't keep its items from being pruned.
+        with self.connection:
+            cursor = self.connection.execute("DELETE FROM consumers WHERE name = ?", (consumer,))
+        return cursor.rowcount > 0
+    def read(self, consumer, limit=1000, after=None):
+        # Returns ([(app_id, new_items)], position), to be acknowledged once the items are handled.
+        # Reads after the consumer's acknowledged position, or after the given one.
+        if after is None:
+            after = self.position(consumer)
+        position = after
+        new_items = {}
+        for id_, app_id, item in self.connection.execute(
+                "SELECT id, app_id, item FROM items WHERE id > ? ORDER BY id LIMIT ?", (after, limit)):
+            new_items.setdefault(app_id, []).append(steambot.feeds.NewsItem.deserialize(json.loads(item)))
+            position = id_
+        return (list(new_items.items()), position)
+    def acknowledge(self, consumer, position):
+        with self.connection:
+            self.connection.execute("INSERT INTO consumers VALUES (?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET position = excluded.position", (consumer, position))
+    def prune(self):
+        with self.connection:
+            cursor = self.connection.execute("DELETE FROM items WHERE created < ? OR id <= (SELECT MIN(position) FROM consumers)",
+                (time.time() - SPOOL_RETENTION_SECONDS,))
+        return cursor.rowcount
+
+class SpoolReader:
+    # Reads ahead of the acknowledged position, and acknowledges each batch once it and the ones before it are handled.
+    def __init__(self, spool, consumer):
+        self.spool = spool
+        self.consumer = consumer
+        self.position = None
+        # [position, handlers still busy with it] for every batch that isn't acknowledged yet, oldest first.
+        self.batches = collections.deque()
+    def read(self):
+        # Returns ([(app_id, new_items)], batch), or ([], None); every hold(batch) needs a release(batch).
+        (new_items, position) = self.spool.read(self.consumer, after=self.position)
+        self.position = position
+        if not new_items:
+            return ([], None)
+        batch = [position, 0]
+        self.batches.append(batch)
+        return (new_items, batch)
+    def hold(self, batch):
+        batch[1] += 1
+    def release(self, batch):
+        batch[1] -= 1
+        position = None
+        while self.batches and self.batches[0][1] == 0:
+            position = self.batches.popleft()[0]
+        if position is not None:
+            self.spool.acknowledge(self.consumer, position)
@@ -1,18 +1,26 @@
+from array import array
+from bisect import bisect_left
 from pathlib import Path
-import pickle
-from collections import defaultdict
+import collections.abc
+import datetime
+import sys
 import tempfile
+import time
 import os
 
-import steambot.feeds
+import steambot.metrics
+import steambot.store
+
+STATE_VERSION = 6
 
 class AtomicBinaryFile:
-    def __init__(self, path):
+    def __init__(self, path, prefix='state_'):
         self.handle = None
         self.temp_path = None
+        self.prefix = prefix
         self.path = Path(path).absolute()
     def __enter__(self):
-        handle, temp_path = tempfile.mkstemp(prefix='state_', dir=self.path.parent)
+        handle, temp_path = tempfile.mkstemp(prefix=self.prefix, dir=self.path.parent)
         self.handle = os.fdopen(handle, 'wb')
         self.temp_path = Path(temp_path)
         return self.handle
@@ -24,13 +32,102 @@ class AtomicBinaryFile:
             self.temp_path.unlink()
         return False
 
+class AppIdSet(array):
+    # The set operations Server needs on a sorted array of app IDs, which takes 4 bytes per ID instead of about 60.
+    __slots__ = ()
+    def __new__(Cls, ids=()):
+        return super().__new__(Cls, 'I', sorted(set(ids)))
+    def _find(self, id_):
+        index = bisect_left(self, id_)
+        return (index, index < len(self) and self[index] == id_)
+    def __contains__(self, id_):
+        return self._find(id_)[1]
+    def add(self, id_):
+        (index, found) = self._find(id_)
+        if not found:
+            self.insert(index, id_)
+    def discard(self, id_):
+        (index, found) = self._find(id_)
+        if found:
+            del self[index]
+    def remove(self, id_):
+        (index, found) = self._find(id_)
+        if not found:
+            raise KeyError(id_)
+        del self[index]
+    def clear(self):
+        del self[:]
+    def serialize(self):
+        # Little-endian, so the state can move to another machine.
+        if sys.byteorder == 'little':
+            return self.tobytes()
+        swapped = array('I', self)
+        swapped.byteswap()
+        return swapped.tobytes()
+    @classmethod
+    def deserialize(Cls, data):
+        instance = Cls()
+        instance.frombytes(data)
+        if sys.byteorder != 'little':
+            instance.byteswap()
+        return instance
+
+class TimestampTable(collections.abc.MutableMapping):
+    # App ID -> timestamp like a dict, in two sorted arrays, which take 12 bytes per app instead of about 100.
+    __slots__ = ('app_ids', 'timestamps')
+    def __init__(self, timestamps=()):
+        items = sorted(dict(timestamps).items())
+        self.app_ids = array('I', [app_id for app_id, _ in items])
+        self.timestamps = array('d', [timestamp for _, timestamp in items])
+    def _find(self, app_id):
+        index = bisect_left(self.app_ids, app_id)
+        return (index, index < len(self.app_ids) and self.app_ids[index] == app_id)
+    def __getitem__(self, app_id):
+        (index, found) = self._find(app_id)
+        if not found:
+            raise KeyError(app_id)
+        return self.timestamps[index]
+    def get(self, app_id, default=None):
+        (index, found) = self._find(app_id)
+        return self.timestamps[index] if found else default
+    def __contains__(self, app_id):
+        return self._find(app_id)[1]
+    def __setitem__(self, app_id, timestamp):
+        (index, found) = self._find(app_id)
+        if found:
+            self.timestamps[index] = timestamp
+        else:
+            self.app_ids.insert(index, app_id)
+            self.timestamps.insert(index, timestamp)
+    def __delitem__(self, app_id):
+        (index, found) = self._find(app_id)
+        if not found:
+            raise KeyError(app_id)
+        del self.app_ids[index]
+        del self.timestamps[index]
+    def __iter__(self):
+        return iter(self.app_ids)
+    def __len__(self):
+        return len(self.app_ids)
+    def serialize(self):
+        return (self.app_ids, self.timestamps)
+    @classmethod
+    def deserialize(Cls, data):
+        instance = Cls()
+        (instance.app_ids, instance.timestamps) = data
+        return instance
+
 class Server:
-    def __init__(self, name, id_, channel=None, subscribed=None):
+    __slots__ = ('name', 'id', 'channel', 'subscribed', 'digest_minutes', 'changed', 'state')
+    def __init__(self, name, id_, channel=None, subscribed=None, digest_minutes=None):
         self.name = name
         self.id = id_
         self.channel = channel
-        self.subscribed = subscribed or set()
+        self.subscribed = subscribed if isinstance(subscribed, AppIdSet) else AppIdSet(subscribed or ())
+        # None posts every item as it comes in; otherwise they are collected and posted together.
+        self.digest_minutes = digest_minutes
         self.changed = False
+        self.state = None
     @classmethod
     def from_context(Cls, ctx):
         name = str(ctx.guild)
@@ -40,15 +137,27 @@ class Server:
         if self.channel == channel:
             return
         self.changed = True
+        old_channel = self.channel
         self.channel = channel
+        if self.state is not None:
+            self.state._channel_set(self, old_channel)
+    def set_digest(self, minutes):
+        if self.digest_minutes == minutes:
+            return
+        self.changed = True
+        self.digest_minutes = minutes
+        if self.state is not None:
+            self.state.store.set_digest(self)
     def add_feed(self, steam_app_id, channel=None):
         new_app_id = int(steam_app_id)
         if new_app_id in self.subscribed:
             return (False, False)
         self.changed = True
-        self.subscribed.add(int(steam_app_id))
+        self.subscribed.add(new_app_id)
+        if self.state is not None:
+            self.state._feed_added(self, new_app_id)
         if self.channel is None and channel is not None:
-            self.channel = int(channel)
+            self.set_channel(int(channel))
             return (True, True)
         return (True, False)
     def remove_feed(self, steam_app_id):
@@ -56,90 +165,302 @@ class Server:
         if steam_app_id not in self.subscribed:
             return False
         self.subscribed.remove(steam_app_id)
+        if self.state is not None:
+            self.state._feed_removed(self, steam_app_id)
         return True
     def purge_feeds(self):
         self.changed = True
+        purged = set(self.subscribed)
         self.subscribed.clear()
+        if self.state is not None:
+            self.state._feeds_purged(self, purged)
     def serialize(self):
-        return (self.name, self.id, self.channel, self.subscribed)
+        return (self.name, self.id, self.channel, self.subscribed.serialize(), self.digest_minutes)
     @classmethod
     def deserialize(Cls, version, data):
-        (name, id_, channel, subscribed) = data
-        return Cls(name, id_, channel, subscribed)
+        digest_minutes = None
+        if version < 4:
+            (name, id_, channel, subscribed) = data
+        else:
+            (name, id_, channel, subscribed, digest_minutes) = data
+        if version >= 5:
+            subscribed = AppIdSet.deserialize(subscribed)
+        return Cls(name, id_, channel, subscribed, digest_minutes)
+
+class DigestBuffer:
+    # New items for the servers that get them as a digest, kept with the state until the digest has been posted.
+    def __init__(self, state, entries=None, clock=time.time):
+        self.state = state
+        self.clock = clock
+        # Server ID -> [(entry ID, time.time() it came in, app_id, app_name, item)], oldest first.
+        self.entries = entries or {}
+        # Server ID -> the last entry ID of the digest that is being posted.
+        self.sending = {}
+        self.next_id = max([entries[-1][0] for entries in self.entries.values()], default=0) + 1
+    def __len__(self):
+        return sum([len(entries) for entries in self.entries.values()])
+    def add(self, server, app_id, app_name, items):
+        now = self.clock()
+        new_entries = []
+        for item in items:
+            new_entries.append((self.next_id, now, app_id, app_name, item))
+            self.next_id += 1
+        self.entries.setdefault(server.id, []).extend(new_entries)
+        self.state.store.add_digest_entries(server, new_entries)
+        self.state.changed = True
+    def due(self):
+        # Returns [(server, last entry ID, [(app_id, app_name, item)])] for the digests that are due; posted() forgets them.
+        now = self.clock()
+        result = []
+        for server_id, entries in self.entries.items():
+            server = self.state.servers.get(server_id)
+            sending = self.sending.get(server_id, 0)
+            waiting = [entry for entry in entries if entry[0] > sending]
+            if server is None or not waiting:
+                continue
+            # Turning the digest off sends what was collected so far.
+            if server.digest_minutes is None or now - waiting[0][1] >= server.digest_minutes * 60:
+                self.sending[server_id] = waiting[-1][0]
+                result.append((server, waiting[-1][0], [(app_id, app_name, item) for _, _, app_id, app_name, item in waiting]))
+        return result
+    def posted(self, server, last_id, delivered):
+        if not delivered:
+            # Due again, so it's retried.
+            self.sending.pop(server.id, None)
+            return
+        entries = [entry for entry in self.entries.get(server.id, []) if entry[0] > last_id]
+        if entries:
+            self.entries[server.id] = entries
+        else:
+            self.entries.pop(server.id, None)
+        if self.sending.get(server.id, 0) <= last_id:
+            self.sending.pop(server.id, None)
+        self.state.store.remove_digest_entries(server, last_id)
+        self.state.changed = True
+    def serialize(self):
+        return [(server_id, [(id_, added, app_id, app_name, item.serialize()) for id_, added, app_id, app_name, item in entries])
+            for server_id, entries in self.entries.items()]
+    @staticmethod
+    def deserialize(data):
+        # Imported here for the same reason as in ProgramState.poll_feeds.
+        import steambot.feeds
+        return dict([(server_id, [(id_, added, app_id, app_name, steambot.feeds.NewsItem.deserialize(item))
+            for id_, added, app_id, app_name, item in entries]) for server_id, entries in data])
 
 class ProgramState:
-    def __init__(self, servers=None, timestamps=None):
+    def __init__(self, servers=None, timestamps=None, validators=None, store=None, failures=None, digests=None):
         self.servers = servers or {}
-        self.timestamps = timestamps or {}
+        if not isinstance(timestamps, TimestampTable):
+            timestamps = TimestampTable(timestamps or ())
+        self.timestamps = timestamps
+        self.validators = validators or {}
+        # App ID -> validator of a feed with new items, saved by advance_feeds.
+        self.new_validators = {}
+        # App ID -> (failed fetches in a row, time.time() of the last one).
+        self.failures = failures or {}
+        self.store = store or steambot.store.MemoryStore()
         self.changed = False
+        self.digests = DigestBuffer(self, digests)
+        # App ID -> {server ID: server} for the servers that are posting somewhere.
+        self.feed_servers = {}
+        for server in self.servers.values():
+            server.state = self
+            self._index_server(server)
     def save(self, config, log):
-        if not self.has_changed():
+        start = time.monotonic()
+        self.store.save(self, log)
+        steambot.metrics.save_seconds.observe(time.monotonic() - start)
+        steambot.metrics.servers.set(len(self.servers))
+        steambot.metrics.subscriptions.set(sum([len(s.subscribed) for s in self.servers.values()]))
+    def _index_feed(self, server, app_id):
+        self.feed_servers.setdefault(app_id, {})[server.id] = server
+    def _unindex_feed(self, server, app_id):
+        servers = self.feed_servers.get(app_id)
+        if servers is None:
             return
-        state_file = Path(config['state_file']).absolute()
-        with AtomicBinaryFile(state_file) as fh:
-            pickle.dump((1, self.serialize()), fh)
-        self.changed = False
-        log.info("State saved to disk.")
+        servers.pop(server.id, None)
+        if not servers:
+            del self.feed_servers[app_id]
+    def _index_server(self, server):
+        if server.channel is not None:
+            for app_id in server.subscribed:
+                self._index_feed(server, app_id)
+    def _channel_set(self, server, old_channel):
+        if old_channel is None:
+            self._index_server(server)
+        elif server.channel is None:
+            for app_id in server.subscribed:
+                self._unindex_feed(server, app_id)
+        self.store.set_channel(server)
+    def _feed_added(self, server, app_id):
+        if server.channel is not None:
+            self._index_feed(server, app_id)
+        self.store.add_feed(server, app_id)
+    def _feed_removed(self, server, app_id):
+        self._unindex_feed(server, app_id)
+        self.store.remove_feed(server, app_id)
+    def _feeds_purged(self, server, app_ids):
+        for app_id in app_ids:
+            self._unindex_feed(server, app_id)
+        self.store.purge_feeds(server)
+    def set_timestamp(self, app_id, timestamp):
+        self.timestamps[app_id] = timestamp
+        self.store.set_timestamp(app_id, timestamp)
+        self.changed = True
+    def set_failures(self, app_id, count):
+        if count:
+            self.failures[app_id] = (count, time.time())
+        elif app_id in self.failures:
+            del self.failures[app_id]
+        else:
+            return
+        self.store.set_failures(app_id, *self.failures.get(app_id, (0, None)))
+        self.changed = True
+    def quarantined(self, min_failures, app_ids=None):
+        # [(app_id, failures, time.time() of the last one)] for the feeds that keep failing, worst first.
+        return sorted([(app_id, count, failed_at) for app_id, (count, failed_at) in self.failures.items()
+            if count >= min_failures and (app_ids is None or app_id in app_ids)], key=lambda x: (-x[1], x[0]))
+    def report_quarantine(self, config, log, steamapps=None, app_ids=None):
+        quarantined = self.quarantined(config['quarantine_failures'], app_ids)
+        steambot.metrics.quarantined_feeds.set(len(quarantined))
+        if not quarantined:
+            return
+        log.warning(f"{len(quarantined)} feeds failed {config['quarantine_failures']} or more times in a row and are polled less often:")
+        for app_id, count, failed_at in quarantined:
+            name = steamapps.name_from_id(app_id) if steamapps is not None else None
+            when = datetime.datetime.fromtimestamp(failed_at).strftime('%Y-%m-%d %H:%M')
+            log.warning(f'  #{app_id} "{name or "<Unknown>"}": {count} failures, last at {when}')
+    def set_validator(self, app_id, validator):
+        self.validators[app_id] = validator
+        self.store.set_validator(app_id, validator)
+        self.changed = True
     def get_server(self, ctx, log):
         guild_id = ctx.guild_id
         if not guild_id:
             return None
         if not guild_id in self.servers:
-            self.servers[guild_id] = Server.from_context(ctx)
-            self.changed = True
+            self.add_server(Server.from_context(ctx))
             log.info(f"Server {ctx.guild}#{guild_id} added. Total servers: {len(self.servers)}")
         return self.servers[guild_id]
+    def add_server(self, server):
+        server.state = self
+        self.servers[server.id] = server
+        self._index_server(server)
+        self.store.add_server(server)
+        self.changed = True
     def get_active_server_feeds(self):
-        feed_servers = defaultdict(list)
-        for server in self.servers.values():
-            if server.channel is not None:
-                for server_feed in server.subscribed:
-                    feed_servers[server_feed].append(server)
-        return feed_servers
-    def check_feeds(self, steamapps, config, log):
+        # Kept up to date by the servers, so this is free. Copy before awaiting anything.
+        return self.feed_servers
+    def subscriber_count(self, app_id):
+        return len(self.feed_servers.get(app_id, ()))
+    async def poll_feeds(self, fetcher, app_ids, subscriber_count, log, scheduler=None):
+        # Returns [(app_id, new_items)] for the feeds in app_ids that are due.
+        # Those feeds stay unread until advance_feeds, so the items are fetched again if they can't be handed on.
+        # Imported here, because `steambot index` uses this module too and doesn't need aiohttp.
+        import steambot.feeds
+        if scheduler is None:
+            app_ids = list(app_ids)
+        else:
+            scheduler.sync(app_ids, self.timestamps, self.failures)
+            app_ids = scheduler.pop_due(app_ids)
+            if not app_ids:
+                return []
+        log.info(f"Checking feeds ({len(app_ids)})")
+        start = time.monotonic()
+        result = []
+        not_modified = 0
+        loaded = await fetcher.load_many(app_ids, self.validators, self.timestamps)
+        failed = len([items for app_id, items, validator in loaded if items is None])
+        outage = scheduler is not None and scheduler.breaker.record(len(loaded), failed)
+        if outage:
+            steambot.metrics.breaker_trips.inc()
+            pause = scheduler.breaker.open_until - scheduler.clock()
+            log.warning(f"{failed} of {len(loaded)} feeds failed, so Steam seems to be down. Pausing all polling for {pause:.0f} seconds.")
+        for app_id, items, validator in loaded:
+            if items is None and not outage:
+                self.set_failures(app_id, self.failures.get(app_id, (0, None))[0] + 1)
+            elif items is not None:
+                self.set_failures(app_id, 0)
+            if scheduler is not None:
+                failures = 0 if outage else self.failures.get(app_id, (0, None))[0]
+                scheduler.reschedule(app_id, items, subscriber_count(app_id), self.timestamps.get(app_id), failures)
+            if items is steambot.feeds.NOT_MODIFIED:
+                not_modified += 1
+            # The fetcher only returns items newer than the app's timestamp.
+            if not items or items is steambot.feeds.NOT_MODIFIED:
+                if validator != self.validators.get(app_id) and items is not None:
+                    self.set_validator(app_id, validator)
+                continue
+            self.new_validators[app_id] = validator
+            result.append((app_id, items))
+        seconds = time.monotonic() - start
+        steambot.metrics.sweep_seconds.observe(seconds)
+        log.debug(f"Checked {len(app_ids)} feeds ({not_modified} not modified) in {seconds:.1f} seconds")
+        return result
+    def advance_feeds(self, new_items):
+        # Marks the items from poll_feeds as read.
+        for app_id, items in new_items:
+            self.set_timestamp(app_id, items[-1].timestamp())
+            if app_id in self.new_validators:
+                validator = self.new_validators.pop(app_id)
+                if validator != self.validators.get(app_id):
+                    self.set_validator(app_id, validator)
+    def with_servers(self, new_items, steamapps):
+        # Returns [(servers, app_id, app_name, new_items)] for the apps that still have subscribers.
         feed_servers = self.get_active_server_feeds()
-        log.info(f"Checking feeds ({len(feed_servers)})")
         result = []
-        for app_id in feed_servers.keys():
-            try:
-                items = steambot.feeds.load(app_id, config, log)
-                if app_id not in self.timestamps:
-                    # Feed not seen before, only get latest item.
-                    new = items[-1:]
-                else:
-                    # Feed seen before, get new items.
-                    new = steambot.feeds.items_after(items, self.timestamps[app_id])
-                if new:
-                    app_name = steamapps.name_from_id(app_id) or '<Unknown>'
-                    result.append((feed_servers[app_id], app_id, app_name, new))
-                    self.timestamps[app_id] = new[-1].timestamp()
-                    self.changed = True
-            except Exception as ex:
-                log.warning(f"Error getting feed #{app_id}: {ex}")
+        for app_id, items in new_items:
+            servers = list(feed_servers.get(app_id, {}).values())
+            if servers:
+                app_name = steamapps.name_from_id(app_id) or '<Unknown>'
+                result.append((servers, app_id, app_name, items))
         return result
+    async def check_feeds(self, fetcher, steamapps, config, log, scheduler=None):
+        feed_servers = self.get_active_server_feeds()
+        steambot.metrics.active_feeds.set(len(feed_servers))
+        new_items = await self.poll_feeds(fetcher, feed_servers, self.subscriber_count, log, scheduler)
+        self.advance_feeds(new_items)
+        return self.with_servers(new_items, steamapps)
     def has_changed(self):
         if self.changed:
             return True
         return any([s.changed for s in self.servers.values()])
+    def clear_changed(self):
+        self.changed = False
+        for server in self.servers.values():
+            server.changed = False
     def serialize(self):
         servers = [(k, v.serialize()) for k, v in self.servers.items()]
-        timestamps = self.timestamps
-        return (servers, timestamps)
+        timestamps = self.timestamps.serialize()
+        validators = self.validators
+        failures = self.failures
+        digests = self.digests.serialize()
+        return (servers, timestamps, validators, failures, digests)
     @classmethod
-    def load(Cls, config, log):
-        state_file = Path(config['state_file']).absolute()
-        if not state_file.is_file():
+    def load(Cls, config, log, shards=None):
+        # With shards=(shard_ids, shard_count), only the servers on those shards are loaded.
+        store = steambot.store.create_store(config)
+        loaded = store.load(log, shards)
+        if loaded is None:
             log.info("No state found, creating new...")
-            return Cls()
-        else:
-            log.info("Loading previous state...")
-            with open(state_file, 'rb') as fh:
-                (version, data) = pickle.load(fh)
-            instance = Cls.deserialize(version, data)
-            log.info(f"State loaded: {len(instance.servers)} servers and {len(instance.timestamps)} feeds")
-            return instance
+            return Cls(store=store)
+        instance = Cls.deserialize(*loaded, store=store)
+        log.info(f"State loaded: {len(instance.servers)} servers and {len(instance.timestamps)} feeds")
+        return instance
     @classmethod
-    def deserialize(Cls, version, data):
-        (servers, timestamps) = data
+    def deserialize(Cls, version, data, store=None):
+        validators = {}
+        failures = {}
+        digests = []
+        if version < 2:
+            (servers, timestamps) = data
+        elif version < 3:
+            (servers, timestamps, validators) = data
+        elif version < 6:
+            (servers, timestamps, validators, failures) = data
+        else:
+            (servers, timestamps, validators, failures, digests) = data
+        if version >= 5:
+            timestamps = TimestampTable.deserialize(timestamps)
         servers = dict([(k, Server.deserialize(version, v)) for k, v in servers])
-        return Cls(servers, timestamps)
\ No newline at end of file
+        return Cls(servers, timestamps, validators, store, failures, DigestBuffer.deserialize(digests))
\ No newline at end of file
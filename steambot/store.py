@@ -0,0 +1,212 @@
+from pathlib import Path
+import json
+import os
+import pickle
+import sqlite3
+
+import steambot.state
+
+class MemoryStore:
+    # Keeps nothing; the base for stores that don't need to hear about every change.
+    def load(self, log, shards=None):
+        return None
+    def save(self, state, log):
+        pass
+    def close(self):
+        pass
+    def add_server(self, server):
+        pass
+    def set_channel(self, server):
+        pass
+    def set_digest(self, server):
+        pass
+    def add_feed(self, server, app_id):
+        pass
+    def remove_feed(self, server, app_id):
+        pass
+    def purge_feeds(self, server):
+        pass
+    def set_timestamp(self, app_id, timestamp):
+        pass
+    def set_validator(self, app_id, validator):
+        pass
+    def set_failures(self, app_id, count, failed_at):
+        pass
+    def add_digest_entries(self, server, entries):
+        pass
+    def remove_digest_entries(self, server, last_id):
+        pass
+
+class PickleStore(MemoryStore):
+    # Writes a snapshot of the whole state whenever it is saved.
+    def __init__(self, path):
+        self.path = Path(path).absolute()
+    def load(self, log, shards=None):
+        if shards is not None:
+            raise Exception("Loading only some shards needs the sqlite state backend!")
+        if not self.path.is_file():
+            return None
+        log.info("Loading previous state...")
+        with open(self.path, 'rb') as fh:
+            return pickle.load(fh)
+    def save(self, state, log):
+        if not state.has_changed():
+            return
+        with steambot.state.AtomicBinaryFile(self.path) as fh:
+            pickle.dump((steambot.state.STATE_VERSION, state.serialize()), fh)
+        state.clear_changed()
+        log.info("State saved to disk.")
+
+class SqliteStore(MemoryStore):
+    # Writes every change as its own small transaction, so nothing is lost in a crash.
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS servers (id INTEGER PRIMARY KEY, name TEXT, channel INTEGER, digest_minutes INTEGER);
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            server_id INTEGER NOT NULL, app_id INTEGER NOT NULL,
+            PRIMARY KEY (server_id, app_id)) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS feeds (
+            app_id INTEGER PRIMARY KEY, timestamp REAL, etag TEXT, last_modified TEXT, digest BLOB,
+            failures INTEGER NOT NULL DEFAULT 0, failed_at REAL);
+        CREATE TABLE IF NOT EXISTS digest_entries (
+            server_id INTEGER NOT NULL, id INTEGER NOT NULL, added REAL NOT NULL, app_id INTEGER NOT NULL, app_name TEXT,
+            item TEXT NOT NULL, PRIMARY KEY (server_id, id)) WITHOUT ROWID;
+    """
+    # Columns added since the first version of the schema, for databases created before them.
+    ADDED_COLUMNS = [
+        ('feeds', 'failures', 'INTEGER NOT NULL DEFAULT 0'),
+        ('feeds', 'failed_at', 'REAL'),
+        ('servers', 'digest_minutes', 'INTEGER'),
+    ]
+    def __init__(self, path, pickle_path=None):
+        self.path = Path(path).absolute()
+        self.pickle_path = pickle_path
+        # The state may be loaded in one thread and used in another.
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA busy_timeout=5000")
+        self.connection.executescript(self.SCHEMA)
+        for table, column, definition in self.ADDED_COLUMNS:
+            if column not in [row[1] for row in self.connection.execute(f"PRAGMA table_info({table})")]:
+                self.connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    def close(self):
+        self.connection.close()
+    def _is_empty(self):
+        return not any([self.connection.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() for table in ['servers', 'feeds']])
+    def _migrate(self, log):
+        # The pickle is renamed once it's migrated, so it's only still there if it wasn't, e.g. when a start was interrupted.
+        pickle_store = PickleStore(self.pickle_path)
+        if not pickle_store.path.is_file():
+            return
+        if not self._is_empty():
+            log.warning(f"Not migrating {pickle_store.path}, {self.path} already has a state")
+            return
+        loaded = pickle_store.load(log)
+        if loaded is None:
+            return
+        log.info(f"Migrating state from {pickle_store.path} to {self.path}...")
+        state = steambot.state.ProgramState.deserialize(*loaded)
+        with self.connection:
+            self.connection.executemany("INSERT INTO servers VALUES (?, ?, ?, ?)",
+                [(s.id, s.name, s.channel, s.digest_minutes) for s in state.servers.values()])
+            self.connection.executemany("INSERT INTO subscriptions VALUES (?, ?)",
+                [(s.id, app_id) for s in state.servers.values() for app_id in s.subscribed])
+            self.connection.executemany("INSERT INTO feeds VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(app_id, state.timestamps.get(app_id), *state.validators.get(app_id, (None, None, None)),
+                    *state.failures.get(app_id, (0, None)))
+                    for app_id in set(state.timestamps) | set(state.validators) | set(state.failures)])
+            self.connection.executemany("INSERT INTO digest_entries VALUES (?, ?, ?, ?, ?, ?)",
+                [(server_id, id_, added, app_id, app_name, json.dumps(item.serialize()))
+                    for server_id, entries in state.digests.entries.items() for id_, added, app_id, app_name, item in entries])
+        os.replace(pickle_store.path, pickle_store.path.with_name(pickle_store.path.name + '.migrated'))
+    def load(self, log, shards=None):
+        if self.pickle_path is not None:
+            self._migrate(log)
+        shard_filter = ''
+        if shards is not None:
+            (shard_ids, shard_count) = shards
+            # Discord's formula for which shard a guild is on.
+            shard_filter = f"WHERE (id >> 22) % {int(shard_count)} IN ({', '.join([str(int(x)) for x in shard_ids])})"
+            log.info(f"Loading servers on shards {shard_ids[0]}-{shard_ids[-1]} of {shard_count}...")
+        servers = {}
+        for id_, name, channel, digest_minutes in self.connection.execute(
+                f"SELECT id, name, channel, digest_minutes FROM servers {shard_filter}"):
+            servers[id_] = (name, id_, channel, set(), digest_minutes)
+        for server_id, app_id in self.connection.execute(
+                f"SELECT server_id, app_id FROM subscriptions WHERE server_id IN (SELECT id FROM servers {shard_filter})"):
+            servers[server_id][3].add(app_id)
+        timestamps = {}
+        validators = {}
+        failures = {}
+        for app_id, timestamp, etag, last_modified, digest, count, failed_at in self.connection.execute(
+                "SELECT app_id, timestamp, etag, last_modified, digest, failures, failed_at FROM feeds"):
+            if timestamp is not None:
+                timestamps[app_id] = timestamp
+            if digest is not None:
+                validators[app_id] = (etag, last_modified, digest)
+            if count:
+                failures[app_id] = (count, failed_at)
+        digests = {}
+        for server_id, id_, added, app_id, app_name, item in self.connection.execute(
+                "SELECT server_id, id, added, app_id, app_name, item FROM digest_entries "
+                f"WHERE server_id IN (SELECT id FROM servers {shard_filter}) ORDER BY server_id, id"):
+            digests.setdefault(server_id, []).append((id_, added, app_id, app_name, json.loads(item)))
+        if not servers and not timestamps:
+            return None
+        # In the format ProgramState.serialize() writes.
+        servers = [(k, (name, id_, channel, steambot.state.AppIdSet(subscribed).serialize(), digest_minutes))
+            for k, (name, id_, channel, subscribed, digest_minutes) in servers.items()]
+        timestamps = steambot.state.TimestampTable(timestamps).serialize()
+        return (steambot.state.STATE_VERSION, (servers, timestamps, validators, failures, list(digests.items())))
+    def active_feeds(self):
+        # {app_id: subscriber count} for servers that are posting somewhere, straight from the database.
+        return dict(self.connection.execute("SELECT app_id, COUNT(*) FROM subscriptions "
+            "JOIN servers ON servers.id = subscriptions.server_id WHERE servers.channel IS NOT NULL GROUP BY app_id"))
+    def add_server(self, server):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO servers VALUES (?, ?, ?, ?)",
+                (server.id, server.name, server.channel, server.digest_minutes))
+    def set_channel(self, server):
+        with self.connection:
+            self.connection.execute("UPDATE servers SET channel = ? WHERE id = ?", (server.channel, server.id))
+    def set_digest(self, server):
+        with self.connection:
+            self.connection.execute("UPDATE servers SET digest_minutes = ? WHERE id = ?", (server.digest_minutes, server.id))
+    def add_feed(self, server, app_id):
+        with self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO subscriptions VALUES (?, ?)", (server.id, app_id))
+    def remove_feed(self, server, app_id):
+        with self.connection:
+            self.connection.execute("DELETE FROM subscriptions WHERE server_id = ? AND app_id = ?", (server.id, app_id))
+    def purge_feeds(self, server):
+        with self.connection:
+            self.connection.execute("DELETE FROM subscriptions WHERE server_id = ?", (server.id,))
+    def set_timestamp(self, app_id, timestamp):
+        with self.connection:
+            self.connection.execute("INSERT INTO feeds (app_id, timestamp) VALUES (?, ?) "
+                "ON CONFLICT (app_id) DO UPDATE SET timestamp = excluded.timestamp", (app_id, timestamp))
+    def set_validator(self, app_id, validator):
+        with self.connection:
+            self.connection.execute("INSERT INTO feeds (app_id, etag, last_modified, digest) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (app_id) DO UPDATE SET etag = excluded.etag, last_modified = excluded.last_modified, "
+                "digest = excluded.digest", (app_id, *validator))
+    def set_failures(self, app_id, count, failed_at):
+        with self.connection:
+            self.connection.execute("INSERT INTO feeds (app_id, failures, failed_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (app_id) DO UPDATE SET failures = excluded.failures, failed_at = excluded.failed_at",
+                (app_id, count, failed_at))
+    def add_digest_entries(self, server, entries):
+        with self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO digest_entries VALUES (?, ?, ?, ?, ?, ?)",
+                [(server.id, id_, added, app_id, app_name, json.dumps(item.serialize())) for id_, added, app_id, app_name, item in entries])
+    def remove_digest_entries(self, server, last_id):
+        with self.connection:
+            self.connection.execute("DELETE FROM digest_entries WHERE server_id = ? AND id <= ?", (server.id, last_id))
+
+def create_store(config):
+    if config['state_backend'] == 'sqlite':
+        return SqliteStore(config['state_database'], config['state_file'])
+    elif config['state_backend'] == 'pickle':
+        return PickleStore(config['state_file'])
+    else:
+        raise Exception(f"Unknown state_backend '{config['state_backend']}', must be 'pickle' or 'sqlite'!")